@@ -0,0 +1,70 @@
+# Benchmarks are run from the repository root, e.g. python3 -m benchmarks.bench_aauthenticate
+
+import os
+import tempfile
+import time
+
+import django
+
+from django.conf import settings
+from django.core.management import call_command
+
+# Run with ACCOUNT_KEYS_UNIQUE=1 in the environment to use unique account keys, from the test_mocks_unique_keys app
+KEYS_UNIQUE = os.environ.get('ACCOUNT_KEYS_UNIQUE') == '1'
+TEST_APP = 'test_mocks_unique_keys' if KEYS_UNIQUE else 'test_mocks'
+
+
+def setup(**overrides):
+    """ Configures Django like run_tests.py, on a throwaway sqlite file that worker threads can share """
+    options = dict(
+        DEBUG=False,
+        INSTALLED_APPS=(
+            'django.contrib.admin',
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'django.contrib.messages',
+            'django.contrib.staticfiles',
+            'rest_framework',
+            'rest_framework.authtoken',
+            'slothauth',
+            TEST_APP,
+        ),
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'),
+            }
+        },
+        ROOT_URLCONF='slothauth.urls',
+        MIDDLEWARE=[
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.middleware.common.CommonMiddleware',
+            'slothauth.middleware.PasswordlessUserMiddleware',
+            'slothauth.middleware.OneTimeAuthenticationKeyMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+        ],
+        AUTH_USER_MODEL=TEST_APP + '.Account',
+        AUTHENTICATION_BACKENDS=[
+            'slothauth.backends.PasswordlessAuthentication',
+        ],
+        ACCOUNT_KEYS_UNIQUE=KEYS_UNIQUE,
+        ALLOWED_HOSTS=['*'],
+        EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+        }],
+    )
+    options.update(overrides)
+    settings.configure(**options)
+    django.setup()
+    call_command('migrate', verbosity=0)
+
+
+def timed(function, repeat):
+    """ Calls function repeat times and returns the calls per second """
+    start = time.time()
+    for i in range(0, repeat):
+        function()
+    return repeat / (time.time() - start)
@@ -0,0 +1,48 @@
+"""
+Email and password logins per second through PasswordlessAuthentication.aauthenticate, for an increasing number of
+hashing workers. Throughput should grow with the number of workers up to the number of cores.
+"""
+
+import asyncio
+import os
+import time
+
+from . import setup
+
+LOGINS = 64
+
+
+def main():
+    setup()
+
+    from django.contrib.auth import get_user_model
+
+    from slothauth import settings
+    from slothauth import backends
+
+    Account = get_user_model()
+    account = Account(email='bench@example.com')
+    account.set_password('password')
+    account.save()
+
+    backend = backends.PasswordlessAuthentication()
+    loop = asyncio.get_event_loop()
+
+    cores = os.cpu_count() or 1
+    print('%d cores, %d logins per run' % (cores, LOGINS))
+    for workers in sorted(set([1, 2, 4, cores])):
+        settings.ACCOUNT_AUTHENTICATION_WORKERS = workers
+        backends._authentication_executor = None
+
+        start = time.time()
+        users = loop.run_until_complete(asyncio.gather(*[
+            backend.aauthenticate(None, email=account.email, password='password') for i in range(0, LOGINS)]))
+        elapsed = time.time() - start
+
+        assert all(user == account for user in users)
+        print('%2d workers: %7.1f logins/s' % (workers, LOGINS / elapsed))
+        backends.get_authentication_executor().shutdown()
+
+
+if __name__ == '__main__':
+    main()
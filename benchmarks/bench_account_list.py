@@ -0,0 +1,55 @@
+"""
+Serializes 10,000 accounts with AccountSerializer, from AccountViewSet's queryset, which joins auth_token, and from
+a plain queryset, which queries each account's token separately.
+"""
+
+import collections
+import time
+
+from . import setup
+
+ACCOUNTS = 10000
+
+
+def main():
+    setup()
+
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from rest_framework.authtoken.models import Token
+
+    from slothauth.serializers import AccountSerializer
+    from slothauth.utils import get_random_fields
+    from slothauth.views import AccountViewSet
+
+    Account = get_user_model()
+
+    # bulk_create sends no pre_save or post_save, so keys and tokens are made here
+    fields = get_random_fields(Account)
+    accounts = []
+    for i in range(0, ACCOUNTS):
+        account = Account(email='bench{0}@example.com'.format(i), password='!')
+        for field in fields:
+            setattr(account, field.attname, field.generate_value())
+        accounts.append(account)
+    Account.objects.bulk_create(accounts, batch_size=500)
+    Token.objects.bulk_create([Token(key=Token().generate_key(), user_id=pk)
+                               for pk in Account.objects.values_list('pk', flat=True)], batch_size=500)
+
+    # Room to log every query of the unjoined run
+    connection.queries_log = collections.deque(maxlen=ACCOUNTS * 2)
+    for name, queryset in (('select_related', AccountViewSet.queryset.all()), ('per account', Account.objects.all())):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            data = AccountSerializer(queryset, many=True).data
+            elapsed = time.perf_counter() - start
+        assert len(data) == ACCOUNTS
+        if queryset.query.select_related:
+            assert len(queries) == 1, len(queries)
+        print('%-15s %7.3f s %6d queries' % (name, elapsed, len(queries)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""
+Time to serialize one account for a login or /accounts/me response, with AccountSerializer and FastAccountSerializer.
+"""
+
+import time
+
+from . import setup
+
+REPEAT = 20000
+
+
+def main():
+    setup()
+
+    from slothauth.factories import AccountFactory
+    from slothauth.serializers import AccountSerializer, FastAccountSerializer
+    from slothauth.views import AccountViewSet
+
+    account = AccountViewSet.queryset.get(pk=AccountFactory(first_name='Bench', last_name='Mark').pk)
+
+    for serializer_class in (AccountSerializer, FastAccountSerializer):
+        start = time.perf_counter()
+        for i in range(0, REPEAT):
+            serializer_class(account).data
+        elapsed = time.perf_counter() - start
+        print('%-22s %6.1f us per account' % (serializer_class.__name__, elapsed / REPEAT * 1e6))
+
+
+if __name__ == '__main__':
+    main()
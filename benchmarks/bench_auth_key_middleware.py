@@ -0,0 +1,50 @@
+"""
+Per request time of the stacked PasswordlessUserMiddleware, OneTimeAuthenticationKeyMiddleware and
+ImpersonateMiddleware against the single AuthKeyMiddleware, for requests without a key and with a bogus key, with
+ModelBackend configured next to PasswordlessAuthentication.
+"""
+
+from . import setup, timed
+
+REQUESTS = 2000
+
+
+def main():
+    setup(AUTHENTICATION_BACKENDS=[
+        'slothauth.backends.PasswordlessAuthentication',
+        'django.contrib.auth.backends.ModelBackend',
+    ])
+
+    from django.contrib.auth.models import AnonymousUser
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+
+    from slothauth import settings
+    from slothauth.middleware import AuthKeyMiddleware, ImpersonateMiddleware, OneTimeAuthenticationKeyMiddleware, \
+        PasswordlessUserMiddleware
+
+    def view(request):
+        return HttpResponse()
+
+    stacked = view
+    for middleware_class in (ImpersonateMiddleware, OneTimeAuthenticationKeyMiddleware, PasswordlessUserMiddleware):
+        stacked = middleware_class(stacked)
+    unified = AuthKeyMiddleware(view)
+
+    factory = RequestFactory()
+
+    def make_request(data):
+        request = factory.get('/', data)
+        request.session = SessionStore()
+        request.user = AnonymousUser()
+        return request
+
+    for name, data in (('no key', {}), ('bogus key', {settings.PASSWORDLESS_GET_PARAM: 'bogus'})):
+        for chain_name, chain in (('stacked', stacked), ('unified', unified)):
+            rate = timed(lambda: chain(make_request(data)), REQUESTS)
+            print('%-10s %-8s %8.1f us per request' % (name, chain_name, 1e6 / rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Per request overhead of PasswordlessUserMiddleware, OneTimeAuthenticationKeyMiddleware and ImpersonateMiddleware
+stacked the way an ASGI handler runs them, for requests that carry no key.
+
+"native" runs the middleware's async path. "thread hop" emulates how Django adapts sync only middleware under ASGI,
+by running each middleware's sync path in a worker thread.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from . import setup
+
+REQUESTS = 20000
+
+
+def main():
+    setup()
+
+    from django.contrib.auth.models import AnonymousUser
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+
+    from slothauth.middleware import ImpersonateMiddleware, OneTimeAuthenticationKeyMiddleware, \
+        PasswordlessUserMiddleware
+
+    classes = (ImpersonateMiddleware, OneTimeAuthenticationKeyMiddleware, PasswordlessUserMiddleware)
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    async def view(request):
+        return HttpResponse()
+
+    native = view
+    for middleware_class in classes:
+        native = middleware_class(native)
+
+    def hop(middleware_class, get_response):
+        middleware = middleware_class(lambda request: request)
+
+        async def adapted(request):
+            await loop.run_in_executor(executor, middleware, request)
+            return await get_response(request)
+        return adapted
+
+    hopped = view
+    for middleware_class in classes:
+        hopped = hop(middleware_class, hopped)
+
+    request = RequestFactory().get('/')
+    request.user = AnonymousUser()
+    # Set by SessionMiddleware, empty for a request without a session cookie
+    request.session = SessionStore()
+
+    async def run(chain):
+        start = loop.time()
+        for i in range(0, REQUESTS):
+            await chain(request)
+        return (loop.time() - start) / REQUESTS * 1e6
+
+    baseline = loop.run_until_complete(run(view))
+    for name, chain in (('native', native), ('thread hop', hopped)):
+        overhead = loop.run_until_complete(run(chain)) - baseline
+        print('%-10s %6.1f us per request' % (name, overhead))
+
+
+if __name__ == '__main__':
+    main()
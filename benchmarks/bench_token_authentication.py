@@ -0,0 +1,49 @@
+"""
+Throughput of GET /api/v1/accounts/me/ authenticated with a DRF token, with TokenAuthentication and with
+CachedTokenAuthentication.
+"""
+
+import tempfile
+import time
+
+from . import setup
+
+REQUESTS = 2000
+
+
+def main():
+    # CachedTokenAuthentication needs a cache shared between processes, a file based one stands in for memcached
+    setup(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                  'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                             'LOCATION': tempfile.mkdtemp()}},
+          ACCOUNT_TOKEN_CACHE='shared')
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from rest_framework.authentication import TokenAuthentication
+    from rest_framework.authtoken.models import Token
+    from rest_framework.test import APIClient
+
+    from slothauth.authentication import CachedTokenAuthentication
+    from slothauth.factories import AccountFactory
+    from slothauth.views import AccountViewSet
+
+    account = AccountFactory()
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.get(user=account).key)
+
+    for authentication_class in (TokenAuthentication, CachedTokenAuthentication):
+        AccountViewSet.authentication_classes = (authentication_class, )
+        client.get('/api/v1/accounts/me/')
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for i in range(0, REQUESTS):
+                client.get('/api/v1/accounts/me/')
+            elapsed = time.perf_counter() - start
+        print('%-26s %7.0f requests/s %5.1f queries per request' %
+              (authentication_class.__name__, REQUESTS / elapsed, len(queries) / REQUESTS))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,10 @@ from django.core.management import call_command
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Run with ACCOUNT_KEYS_UNIQUE=1 in the environment to use unique account keys, from the test_mocks_unique_keys app
+KEYS_UNIQUE = os.environ.get('ACCOUNT_KEYS_UNIQUE') == '1'
+TEST_APP = 'test_mocks_unique_keys' if KEYS_UNIQUE else 'test_mocks'
+
 settings.configure(
     DEBUG=True,
     INSTALLED_APPS=(
@@ -23,7 +27,7 @@ settings.configure(
         'rest_framework',
         'rest_framework.authtoken',
         'slothauth',
-        'test_mocks',
+        TEST_APP,
     ),
     DATABASES={
         'default': {
@@ -32,7 +36,7 @@ settings.configure(
         }
     },
     ROOT_URLCONF = 'slothauth.urls',
-    MIDDLEWARE_CLASSES=[
+    MIDDLEWARE=[
         'django.middleware.security.SecurityMiddleware',
         'django.contrib.sessions.middleware.SessionMiddleware',
         'django.middleware.common.CommonMiddleware',
@@ -43,6 +47,7 @@ settings.configure(
         'django.contrib.messages.middleware.MessageMiddleware',
         'django.middleware.clickjacking.XFrameOptionsMiddleware',
     ],
+    AUTH_USER_MODEL=TEST_APP + '.Account',
     AUTHENTICATION_BACKENDS=[
         'slothauth.backends.PasswordlessAuthentication',
     ],
@@ -50,5 +55,5 @@ settings.configure(
 
 django.setup()
 call_command('makemigrations', 'slothauth')
-call_command('makemigrations', 'test_mocks')
+call_command('makemigrations', TEST_APP)
 
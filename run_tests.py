@@ -4,6 +4,7 @@
 
 import os
 import sys
+import tempfile
 import django
 
 from django.conf import settings
@@ -11,6 +12,10 @@ from django.core.management import call_command
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Run with ACCOUNT_KEYS_UNIQUE=1 in the environment to use unique account keys, from the test_mocks_unique_keys app
+KEYS_UNIQUE = os.environ.get('ACCOUNT_KEYS_UNIQUE') == '1'
+TEST_APP = 'test_mocks_unique_keys' if KEYS_UNIQUE else 'test_mocks'
+
 settings.configure(DEBUG=True,
                    INSTALLED_APPS=(
                        'django.contrib.admin',
@@ -22,7 +27,7 @@ settings.configure(DEBUG=True,
                        'rest_framework',
                        'rest_framework.authtoken',
                        'slothauth',
-                       'test_mocks',
+                       TEST_APP,
                    ),
                    DATABASES={
                        'default': {
@@ -30,6 +35,16 @@ settings.configure(DEBUG=True,
                             'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
                        }
                    },
+                   CACHES={
+                       'default': {
+                           'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                       },
+                       # Stands in for a cache shared between processes, like memcached or redis
+                       'shared': {
+                           'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                           'LOCATION': tempfile.mkdtemp(),
+                       },
+                   },
                    ROOT_URLCONF='slothauth.urls',
                    MIDDLEWARE=[
                        'django.middleware.security.SecurityMiddleware',
@@ -43,11 +58,12 @@ settings.configure(DEBUG=True,
                        'django.contrib.messages.middleware.MessageMiddleware',
                        'django.middleware.clickjacking.XFrameOptionsMiddleware',
                    ],
-                   AUTH_USER_MODEL='test_mocks.Account',
+                   AUTH_USER_MODEL=TEST_APP + '.Account',
                    AUTHENTICATION_BACKENDS=[
                        'slothauth.backends.PasswordlessAuthentication',
                    ],
                    ACCOUNT_FORM='slothauth.forms.AccountForm',
+                   ACCOUNT_KEYS_UNIQUE=KEYS_UNIQUE,
                    TEMPLATES=[{
                        'BACKEND': 'django.template.backends.django.DjangoTemplates',
                        'DIRS': [],
@@ -0,0 +1,68 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+
+from rest_framework.authentication import TokenAuthentication
+
+from .utils import get_shared_cache, instance_from_row, instance_to_row
+
+from . import settings
+
+
+Account = get_user_model()
+
+
+class TokenCache(object):
+    """
+    Maps token keys to a snapshot of their user in the Django cache named by ACCOUNT_TOKEN_CACHE. Also remembers each
+    user's token key, so that saving a user can evict it.
+    """
+
+    @property
+    def cache(self):
+        return get_shared_cache(settings.ACCOUNT_TOKEN_CACHE, 'ACCOUNT_TOKEN_CACHE')
+
+    def get(self, key):
+        return self.cache.get('slothauth:token:%s' % key)
+
+    def set(self, key, user):
+        self.cache.set_many({'slothauth:token:%s' % key: instance_to_row(user),
+                             'slothauth:token_key:%s' % user.pk: key}, settings.ACCOUNT_TOKEN_CACHE_TIMEOUT)
+
+    def delete(self, key):
+        if settings.ACCOUNT_TOKEN_CACHE:
+            self.evict(['slothauth:token:%s' % key])
+
+    def delete_user(self, user_id):
+        if settings.ACCOUNT_TOKEN_CACHE:
+            key = caches[settings.ACCOUNT_TOKEN_CACHE].get('slothauth:token_key:%s' % user_id)
+            if key is not None:
+                self.evict(['slothauth:token:%s' % key])
+
+    def evict(self, cache_keys):
+        cache = caches[settings.ACCOUNT_TOKEN_CACHE]
+        cache.delete_many(cache_keys)
+        # A request reading the old row before the change commits could cache it again
+        transaction.on_commit(lambda: cache.delete_many(cache_keys))
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that resolves a token to its user from token_cache, so authenticated API calls don't query
+    the token and user tables. Deleting a token and saving or deleting a user evict the cached entry for every
+    process, so ACCOUNT_TOKEN_CACHE must name a cache they all share.
+    """
+
+    def authenticate_credentials(self, key):
+        row = token_cache.get(key)
+        if row is not None:
+            user = instance_from_row(Account, row)
+            return (user, self.get_model()(key=key, user=user))
+
+        user, token = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+        # Only active users get past authenticate_credentials, saving one as inactive evicts it
+        token_cache.set(key, user)
+        return (user, token)
@@ -1,4 +1,18 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.db.models import F
+
+from .models import AuthKey
+from .signed_keys import load_signed_key
+from .utils import failed_keys, get_shared_cache, instance_from_row, instance_to_row
+
+from . import settings
 
 
 Account = get_user_model()
@@ -13,24 +27,161 @@ class PasswordlessAuthentication(object):
             email = username
         user = None
         if email and password:
-            user = Account.objects.filter(email__iexact=email).last()
+            # The token is joined for the account serializer that login responds with
+            user = Account.objects.filter(email__iexact=email).select_related('auth_token').last()
             if user and not user.check_password(password):
                 # Password didn't check out
                 user = None
         elif passwordless_key:
-            user = Account.objects.filter(passwordless_key=passwordless_key).last()
+            user = self.get_user_by_passwordless_key(passwordless_key)
 
             if user and not user.is_passwordless and not force:
                 # Cannot use a passwordless key for someone who has a password
                 user = None
         elif one_time_authentication_key:
-            user = Account.objects.filter(one_time_authentication_key=one_time_authentication_key).last()
+            user = self.get_user_by_one_time_authentication_key(one_time_authentication_key)
+
+        return user
+
+    async def aauthenticate(self, request=None, **credentials):
+        """
+        Coroutine version of authenticate for async deployments. The lookup and the password hash check run in a
+        bounded pool of ACCOUNT_AUTHENTICATION_WORKERS threads, so they never stall the event loop. The PBKDF2 hasher
+        releases the GIL, so login throughput scales with the number of workers up to the number of cores.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(get_authentication_executor(),
+                                          functools.partial(run_in_worker, self.authenticate, **credentials))
+
+    def get_user_by_passwordless_key(self, passwordless_key):
+        if settings.ACCOUNT_SIGNED_KEYS:
+            # Forged, mangled and expired keys are turned away before any query
+            signed_key = load_signed_key(passwordless_key, AuthKey.PASSWORDLESS)
+            if signed_key is None:
+                return None
+            user_id, version = signed_key
+            return Account.objects.filter(pk=user_id, auth_key_version=version).first()
+        if failed_keys.has_failed(passwordless_key, AuthKey.PASSWORDLESS):
+            return None
+        if settings.ACCOUNT_AUTH_KEYS:
+            user = AuthKey.objects.get_user(passwordless_key, AuthKey.PASSWORDLESS)
+        else:
+            user = Account.objects.filter(passwordless_key=passwordless_key).last()
+        if user is None:
+            failed_keys.add(passwordless_key, AuthKey.PASSWORDLESS)
+        return user
+
+    def get_user_by_one_time_authentication_key(self, one_time_authentication_key):
+        if settings.ACCOUNT_SIGNED_KEYS:
+            signed_key = load_signed_key(one_time_authentication_key, AuthKey.ONE_TIME_AUTHENTICATION)
+            if signed_key is None:
+                return None
+            user_id, version = signed_key
+            # Moving the version on uses up the key, and every other signed key issued before it
+            if not Account.objects.filter(pk=user_id, auth_key_version=version)\
+                                  .update(auth_key_version=F('auth_key_version') + 1):
+                return None
+            invalidate_cached_user(user_id)
+            return Account.objects.filter(pk=user_id).first()
+        if failed_keys.has_failed(one_time_authentication_key, AuthKey.ONE_TIME_AUTHENTICATION):
+            return None
+        user = self.consume_one_time_authentication_key(one_time_authentication_key)
+        if user is None:
+            # Used up keys are remembered as well, the link is usually opened more than once
+            failed_keys.add(one_time_authentication_key, AuthKey.ONE_TIME_AUTHENTICATION)
+        return user
 
-            if user:
-                user.one_time_authentication_key = Account._meta.get_field('one_time_authentication_key').generate_unique(instance=user, sender=Account)
-                user.save()
+    def consume_one_time_authentication_key(self, one_time_authentication_key):
+        if settings.ACCOUNT_AUTH_KEYS:
+            return AuthKey.objects.consume(one_time_authentication_key, AuthKey.ONE_TIME_AUTHENTICATION)
 
+        user = Account.objects.filter(one_time_authentication_key=one_time_authentication_key).last()
+        if user:
+            # Swap the key only if it is still the one we looked up, so that of several concurrent requests using the
+            # same key exactly one gets to log in
+            new_key = Account._meta.get_field('one_time_authentication_key').generate_value()
+            failed_keys.forget(new_key)
+            if not Account.objects.filter(pk=user.pk, one_time_authentication_key=one_time_authentication_key)\
+                                  .update(one_time_authentication_key=new_key):
+                return None
+            user.one_time_authentication_key = new_key
+            # update() sends no post_save
+            invalidate_cached_user(user.pk)
         return user
 
     def get_user(self, user_id):
-        return Account.objects.filter(id=user_id).last()
+        if not settings.ACCOUNT_USER_CACHE:
+            # Joined for /accounts/me, which serializes the token
+            return Account.objects.filter(pk=user_id).select_related('auth_token').first()
+
+        # Keyed on the session's password hash as well, so a session whose password changed misses the cache. The
+        # snapshot includes the password hash, so Django's session hash check still logs out the other sessions.
+        cache = get_user_cache()
+        key = get_user_cache_key(user_id, getattr(_session, 'auth_hash', None))
+        row = cache.get(key)
+        if row is not None:
+            return instance_from_row(Account, row)
+        user = Account.objects.filter(pk=user_id).first()
+        if user:
+            # Every key of the account is listed under its id, for invalidate_cached_user
+            index_key = get_user_cache_index_key(user_id)
+            keys = cache.get(index_key) or []
+            cache.set_many({key: instance_to_row(user), index_key: list(set(keys) | {key})},
+                           settings.ACCOUNT_USER_CACHE_TIMEOUT)
+        return user
+
+
+_session = threading.local()
+
+
+@contextmanager
+def session_auth_hash(auth_hash):
+    """ Makes the session's password hash known to get_user, set by slothauth.middleware.AuthenticationMiddleware """
+    previous = getattr(_session, 'auth_hash', None)
+    _session.auth_hash = auth_hash
+    try:
+        yield
+    finally:
+        _session.auth_hash = previous
+
+
+def get_user_cache():
+    # Saves and logouts have to reach every process, a per process cache would keep serving the old account
+    return get_shared_cache(settings.ACCOUNT_USER_CACHE, 'ACCOUNT_USER_CACHE')
+
+
+def get_user_cache_key(user_id, auth_hash):
+    return 'slothauth:user:%s:%s' % (user_id, (auth_hash or '')[:16])
+
+
+def get_user_cache_index_key(user_id):
+    return 'slothauth:user:%s' % user_id
+
+
+def invalidate_cached_user(user_id):
+    if settings.ACCOUNT_USER_CACHE:
+        cache = get_user_cache()
+        index_key = get_user_cache_index_key(user_id)
+        cache.delete_many((cache.get(index_key) or []) + [index_key])
+
+
+def run_in_worker(function, *args, **kwargs):
+    # Worker threads keep their own database connection, recycle it like Django does around a request
+    close_old_connections()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+_authentication_executor = None
+_authentication_executor_lock = threading.Lock()
+
+
+def get_authentication_executor():
+    global _authentication_executor
+    if _authentication_executor is None:
+        with _authentication_executor_lock:
+            if _authentication_executor is None:
+                _authentication_executor = ThreadPoolExecutor(max_workers=settings.ACCOUNT_AUTHENTICATION_WORKERS)
+    return _authentication_executor
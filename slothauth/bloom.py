@@ -0,0 +1,210 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+
+from .utils import get_shared_cache
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """
+    Set of strings that can answer "definitely not present" or "probably present". Sized for capacity items at the
+    given false positive rate.
+    """
+
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray(bits) if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = count
+
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(0, self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+    @property
+    def false_positive_rate(self):
+        """ Expected false positive rate with the number of items added so far """
+        return (1 - math.exp(-self.hashes * self.count / float(self.size))) ** self.hashes
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+class EmailFilter(object):
+    """
+    Bloom filter of every account's email, kept in process memory. It is loaded in a background thread from a
+    snapshot in the ACCOUNT_EMAIL_BLOOM_FILTER_CACHE cache, or by streaming the accounts table. Each committed email
+    change bumps a generation counter in that cache. A process that sees a generation it hasn't seen can't trust its
+    misses and answers "might exist" until it has reloaded, which it tries at most every
+    ACCOUNT_EMAIL_BLOOM_FILTER_REFRESH seconds, so a miss is always a real miss.
+    """
+
+    GENERATION_KEY = 'slothauth:email_filter:generation'
+    SNAPSHOT_KEY = 'slothauth:email_filter:snapshot'
+    REBUILD_LOCK_KEY = 'slothauth:email_filter:rebuilding'
+    # Seconds after which a rebuild that died without releasing the lock stops blocking others
+    REBUILD_LOCK_TIMEOUT = 600
+    # memcached refuses items over 1 MB by default, the snapshot is stored in pieces below that
+    SNAPSHOT_CHUNK_SIZE = 512 * 1024
+
+    def __init__(self):
+        self.bloom = None
+        self.generation = None
+        self.refreshed_at = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        # Every process has to see every bump, a per process cache would hand out false misses
+        return get_shared_cache(settings.ACCOUNT_EMAIL_BLOOM_FILTER_CACHE, 'ACCOUNT_EMAIL_BLOOM_FILTER_CACHE')
+
+    def get_generation(self):
+        return self.cache.get(self.GENERATION_KEY, 0)
+
+    def might_exist(self, email):
+        """ False only if no account has this email. Always True while the filter is off or stale """
+        if not settings.ACCOUNT_EMAIL_BLOOM_FILTER:
+            return True
+        generation = self.get_generation()
+        # The filter is replaced before its generation, so a current generation never pairs with an older filter
+        if generation != self.generation:
+            if time.time() - self.refreshed_at > settings.ACCOUNT_EMAIL_BLOOM_FILTER_REFRESH:
+                self.refresh()
+            self.misses += 1
+            return True
+        if normalize_email(email) in self.bloom:
+            self.misses += 1
+            return True
+        self.hits += 1
+        return False
+
+    def refresh(self):
+        """ Reloads the filter in a background thread, requests keep using the database until it is current """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.refreshed_at = time.time()
+            self.thread = threading.Thread(target=self._refresh, name='slothauth-email-filter')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _refresh(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception('Failed to refresh the email Bloom filter')
+        finally:
+            connections.close_all()
+
+    def load(self):
+        """
+        Loads the stored snapshot, or rebuilds it from the accounts table when it is missing or stale. Only one
+        process rebuilds at a time, the others pick up its snapshot on their next refresh.
+        """
+        snapshot = self.get_snapshot()
+        if snapshot is None or snapshot[0] != self.get_generation():
+            if not self.cache.add(self.REBUILD_LOCK_KEY, True, self.REBUILD_LOCK_TIMEOUT):
+                return
+            try:
+                snapshot = self.rebuild()
+            finally:
+                self.cache.delete(self.REBUILD_LOCK_KEY)
+        generation, bits, count = snapshot
+        bloom = BloomFilter(settings.ACCOUNT_EMAIL_BLOOM_FILTER_CAPACITY,
+                            settings.ACCOUNT_EMAIL_BLOOM_FILTER_ERROR_RATE, bits=bits, count=count)
+        with self.lock:
+            self.bloom = bloom
+            self.generation = generation
+
+    def get_snapshot(self):
+        header = self.cache.get(self.SNAPSHOT_KEY)
+        if header is None:
+            return None
+        generation, count, chunk_keys = header
+        chunks = self.cache.get_many(chunk_keys)
+        if len(chunks) != len(chunk_keys):
+            # Some pieces were evicted
+            return None
+        return generation, b''.join(chunks[key] for key in chunk_keys), count
+
+    def rebuild(self):
+        """ Builds the filter from the accounts table and stores it in the cache for other processes """
+        # Read first, emails committed during the scan then leave the snapshot stale rather than missing them
+        generation = self.get_generation()
+        bloom = BloomFilter(settings.ACCOUNT_EMAIL_BLOOM_FILTER_CAPACITY,
+                            settings.ACCOUNT_EMAIL_BLOOM_FILTER_ERROR_RATE)
+        for email in get_user_model()._default_manager.values_list('email', flat=True).iterator():
+            bloom.add(normalize_email(email))
+        bits = bloom.to_bytes()
+
+        # Pieces of concurrent rebuilds don't mix, each rebuild writes its own keys
+        prefix = '%s:%s' % (self.SNAPSHOT_KEY, uuid.uuid4().hex)
+        pieces = [bits[offset:offset + self.SNAPSHOT_CHUNK_SIZE]
+                  for offset in range(0, len(bits), self.SNAPSHOT_CHUNK_SIZE)]
+        chunk_keys = ['%s:%d' % (prefix, i) for i in range(0, len(pieces))]
+        self.cache.set_many(dict(zip(chunk_keys, pieces)), None)
+        previous = self.cache.get(self.SNAPSHOT_KEY)
+        self.cache.set(self.SNAPSHOT_KEY, (generation, bloom.count, chunk_keys), None)
+        if previous is not None:
+            # Stored without a timeout, the replaced pieces would otherwise stay in the cache for good
+            self.cache.delete_many(previous[2])
+        return generation, bits, bloom.count
+
+    def add(self, email, using=None):
+        """ Records a saved email once its transaction commits, called from the account post_save signal """
+        transaction.on_commit(lambda: self.bump(email), using=using)
+
+    def invalidate(self, using=None):
+        """
+        Marks every process's filter stale, for email changes that send no post_save, like QuerySet.update() and
+        bulk_create()
+        """
+        transaction.on_commit(self.bump, using=using)
+
+    def bump(self, email=None):
+        self.cache.add(self.GENERATION_KEY, 0, None)
+        generation = self.cache.incr(self.GENERATION_KEY)
+        # The local filter stays current if it hadn't missed anything before this email
+        with self.lock:
+            if email is not None and self.bloom is not None and generation == self.generation + 1:
+                self.bloom.add(normalize_email(email))
+                self.generation = generation
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': self.bloom.count if self.bloom is not None else 0,
+                'false_positive_rate': self.bloom.false_positive_rate if self.bloom is not None else 0.0}
+
+
+email_filter = EmailFilter()
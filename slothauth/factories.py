@@ -16,7 +16,7 @@ class AccountFactory(factory.django.DjangoModelFactory):
     is_staff = False
     is_active = True
     date_joined = timezone.now()
-    passwordless_key = '12345'
+    passwordless_key = factory.Sequence(lambda n: '12345{0}'.format(n))
 
 
 class AdminFactory(AccountFactory):
@@ -27,4 +27,3 @@ class AdminFactory(AccountFactory):
 class PasswordlessAccountFactory(AccountFactory):
 
     password = "!abcdefghijklmnopqrstuvwxyzabcdefghiklmn"
-    passwordless_key = '12345'
@@ -3,10 +3,11 @@ from django.utils.translation import gettext as _
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.tokens import default_token_generator
-from django.template.loader import render_to_string
+from django.db import IntegrityError, router, transaction
 from django.utils.http import urlsafe_base64_encode
 
-from .mail import send_mail
+from .bloom import email_filter
+from .mail import render_mail, send_many
 from .utils import InstanceDoesNotRequireFieldsMixin
 
 from . import settings
@@ -17,6 +18,8 @@ Account = get_user_model()
 
 class AccountForm(InstanceDoesNotRequireFieldsMixin, forms.ModelForm):
     password = forms.CharField(required=False, widget=forms.PasswordInput)
+    email_taken_message = _("Email address has already been used.")
+    email_checked = True
 
     class Meta:
         model = Account
@@ -27,23 +30,68 @@ class AccountForm(InstanceDoesNotRequireFieldsMixin, forms.ModelForm):
         self.old_password = self.instance.password
 
     def save(self, commit=True, *args, **kwargs):
-        account = super(AccountForm, self).save(commit=commit, *args, **kwargs)
+        # The password is hashed before the account is written, so it is written once
+        account = super(AccountForm, self).save(commit=False, *args, **kwargs)
         password = self.cleaned_data.get('password')
         if self.old_password != password and password:
             account.set_password(password)
         if commit:
-            account.save()
+            if not self.save_account(account, update_fields=self.get_update_fields(account)):
+                return None
+            self._save_m2m()
         return account
 
-    def clean_email(self):
-        email = self.cleaned_data.get('email').lower()
+    def get_update_fields(self, account):
+        """ Columns changed by the form, or None for a new account """
+        if account._state.adding:
+            return None
+        field_names = set(field.name for field in account._meta.concrete_fields)
+        update_fields = [name for name in self.changed_data if name in field_names and name != 'password']
+        if account.password != self.old_password:
+            update_fields.append('password')
+        return update_fields
+
+    def save_account(self, account, update_fields=None):
+        """
+        With ACCOUNT_FORM_OPTIMISTIC_EMAIL, or when the email Bloom filter let clean_email skip its check, the unique
+        index checks the email instead. A clash is turned into the usual email error, and save returns None.
+        """
+        if not settings.ACCOUNT_FORM_OPTIMISTIC_EMAIL and self.email_checked:
+            account.save(update_fields=update_fields)
+            return True
+        try:
+            with transaction.atomic(using=router.db_for_write(Account, instance=account)):
+                account.save(update_fields=update_fields)
+        except IntegrityError:
+            if not self.email_taken(account.email):
+                raise
+            self.add_error('email', self.email_taken_message)
+            return False
+        return True
+
+    def email_taken(self, email):
         accounts = Account.objects.filter(email=email)
         if self.instance:
             accounts = accounts.exclude(id=self.instance.id)
-        if accounts.exists():
-            raise forms.ValidationError(_("Email address has already been used."))
+        return accounts.exists()
+
+    def clean_email(self):
+        email = self.cleaned_data.get('email').lower()
+        if settings.ACCOUNT_FORM_OPTIMISTIC_EMAIL:
+            return email
+        # A Bloom filter miss skips the query, save_account then still catches a clash with the unique index
+        self.email_checked = email_filter.might_exist(email)
+        if self.email_checked and self.email_taken(email):
+            raise forms.ValidationError(self.email_taken_message)
         return email
 
+    def validate_unique(self):
+        # clean_email has already checked the email, or the unique index will
+        try:
+            self.instance.validate_unique(exclude=set(self._get_validation_exclusions()) | {'email'})
+        except forms.ValidationError as e:
+            self._update_errors(e)
+
     def clean_name(self):
         return self.cleaned_data.get('name').strip()
 
@@ -80,17 +128,23 @@ class PasswordResetForm(forms.Form):
         """
         Generates a one-use only link for resetting password and sends to the user.
         """
+        messages = []
         for user in self.users_cache:
             context = {
                 'email': user.email,
                 'uid': urlsafe_base64_encode(bytes(user.id)),
                 'user': user,
                 'token': token_generator.make_token(user),
+                # For templates linking to the change_password API, an AuthKey with ACCOUNT_AUTH_KEYS
+                'password_reset_key': user.get_password_reset_key(),
                 'domain': settings.ACCOUNT_EMAIL_DOMAIN,
                 'protocol': 'http'
             }
-            send_mail(subject,
-                       render_to_string(text_email_template_name, context),
-                       render_to_string(html_email_template_name, context),
-                       settings.ACCOUNT_EMAIL_FROM,
-                       user.email)
+            messages.append(render_mail(subject,
+                                        text_email_template_name,
+                                        html_email_template_name,
+                                        context,
+                                        settings.ACCOUNT_EMAIL_FROM,
+                                        user.email,
+                                        css_file=css_file))
+        send_many(messages)
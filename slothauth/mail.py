@@ -33,11 +33,35 @@ THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-from django.core.mail import EmailMultiAlternatives
+import atexit
+import logging
+import os
+import smtplib
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django.conf import settings as django_settings
+from django.core.cache import caches
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
 from django.utils.translation import ugettext as _
 
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
 
 def send_mail(subject, message_plain, message_html, email_from, email_to, custom_headers={}, attachments=()):
+    send_many([make_mail(subject, message_plain, message_html, email_from, email_to, custom_headers, attachments)])
+
+
+def make_mail(subject, message_plain, message_html, email_from, email_to, custom_headers={}, attachments=()):
 
     if isinstance(email_to, str):
         email_to = [email_to]
@@ -62,4 +86,360 @@ def send_mail(subject, message_plain, message_html, email_from, email_to, custom
     msg = EmailMultiAlternatives(**message)
     if message_html:
         msg.attach_alternative(message_html, "text/html")
-    msg.send()
+    return msg
+
+
+def render_mail(subject, text_template_name, html_template_name, context, email_from, email_to, css_file=None):
+    """ Builds a message from a cached txt/html template pair, see EmailTemplate """
+    message_plain, message_html = get_email_template(text_template_name, html_template_name, css_file).render(context)
+    return make_mail(subject, message_plain, message_html, email_from, email_to)
+
+
+class EmailTemplate(object):
+    """
+    Compiled txt/html email template pair. The css_file, if given, is read and parsed once, when the pair is loaded,
+    and inlined into each rendered html email. Inlining the template source instead would let the html parser
+    URL-escape template tags in href and src attributes.
+    """
+
+    def __init__(self, text_template_name, html_template_name, css_file=None):
+        self.text_template = get_template(text_template_name)
+        self.html_template = get_template(html_template_name)
+        self.css_file = css_file
+        self.css_path = find_css_file(css_file) if css_file else None
+        self.inline_css = None
+        if self.css_path:
+            with open(self.css_path) as f:
+                self.inline_css = make_css_inliner(f.read())
+        elif css_file:
+            logger.info('Email css file %s not found', css_file)
+        self.version = self.get_version()
+
+    def get_version(self):
+        paths = [getattr(template.origin, 'name', None) for template in (self.text_template, self.html_template)]
+        paths.append(self.css_path)
+        return tuple(os.path.getmtime(path) if path and os.path.isfile(path) else None for path in paths)
+
+    def render(self, context):
+        message_html = self.html_template.render(context)
+        if self.inline_css is not None:
+            message_html = self.inline_css(message_html)
+        return self.text_template.render(context), message_html
+
+
+def find_css_file(css_file):
+    if os.path.isfile(css_file):
+        return css_file
+    if django_settings.STATIC_ROOT and os.path.isfile(os.path.join(django_settings.STATIC_ROOT, css_file)):
+        return os.path.join(django_settings.STATIC_ROOT, css_file)
+    if 'django.contrib.staticfiles' in django_settings.INSTALLED_APPS:
+        from django.contrib.staticfiles import finders
+
+        return finders.find(css_file[len('static/'):] if css_file.startswith('static/') else css_file)
+    return None
+
+
+def make_css_inliner(css):
+    """
+    Returns a function that applies css to the style attributes of an html document with premailer if installed, or
+    adds it as a <style> block. premailer keeps the parsed css, so it is only parsed for the first document.
+    """
+    try:
+        from premailer import Premailer
+    except ImportError:
+        Premailer = None
+
+    if Premailer is not None:
+        return Premailer(css_text=css, keep_style_tags=False, disable_validation=True).transform
+
+    style = '<style type="text/css">\n%s\n</style>\n' % css
+
+    def add_style(html):
+        if '</head>' in html:
+            return html.replace('</head>', style + '</head>', 1)
+        return style + html
+    return add_style
+
+
+_email_templates = {}
+_email_templates_lock = threading.Lock()
+
+
+def get_email_template(text_template_name, html_template_name, css_file=None):
+    key = (text_template_name, html_template_name, css_file)
+    email_template = _email_templates.get(key)
+    # Template files are only checked for changes in DEBUG, so edits show up without a restart
+    if email_template is None or (settings.DEBUG and email_template.get_version() != email_template.version):
+        email_template = EmailTemplate(text_template_name, html_template_name, css_file)
+        with _email_templates_lock:
+            _email_templates[key] = email_template
+    return email_template
+
+
+class Coalescer(object):
+    """
+    Lets one email per key through during a window, using add() on a Django cache so that processes sharing the
+    cache agree on who sends. Keeps hit (dropped) and miss (sent) counts for this process.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def claim(self, key, window=None):
+        """ Returns True if the caller should send, False if an email for key went out during the window """
+        window = settings.ACCOUNT_EMAIL_COALESCE_WINDOW if window is None else window
+        if not window:
+            return True
+        claimed = caches[settings.ACCOUNT_EMAIL_COALESCE_CACHE].add('%s:%s' % (self.prefix, key), 1, window)
+        with self.lock:
+            if claimed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return claimed
+
+    def release(self, key):
+        caches[settings.ACCOUNT_EMAIL_COALESCE_CACHE].delete('%s:%s' % (self.prefix, key))
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+passwordless_login_coalescer = Coalescer('slothauth:passwordless_login_email')
+
+
+def send_many(messages):
+    """
+    Sends a list of messages over a single connection. Depending on settings the messages are written to the
+    outbox or handed to the dispatch queue instead.
+    """
+    messages = list(messages)
+
+    if settings.ACCOUNT_EMAIL_OUTBOX:
+        from .models import EmailOutbox
+
+        # Attachments aren't stored in the outbox, those messages are sent right away
+        EmailOutbox.objects.bulk_create([EmailOutbox.from_message(msg) for msg in messages if not msg.attachments])
+        messages = [msg for msg in messages if msg.attachments]
+
+    if not messages:
+        return
+    if settings.ACCOUNT_EMAIL_QUEUE:
+        get_dispatch_queue().put(messages)
+    else:
+        deliver(messages)
+
+
+def deliver(messages):
+    """ Sends messages right away, over a pooled connection unless pooling is turned off """
+    if settings.ACCOUNT_EMAIL_CONNECTION_POOL:
+        return get_connection_pool().send_messages(messages)
+    return get_connection().send_messages(messages)
+
+
+class PooledConnection(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.time()
+        self.last_used = self.created
+        self.reused = False
+
+
+class ConnectionPool(object):
+    """
+    Per process pool of open mail connections.
+
+    Connections older than max_age seconds are closed instead of reused. SMTP connections that sat idle for more than
+    keepalive seconds are checked with a NOOP before being reused. A reused connection that turns out to be dropped
+when its first message is sent is replaced with a new one once. Messages are sent one at a time and a drop
+partway through a batch is raised, so messages the server may already have accepted are never sent twice.
+    """
+
+    def __init__(self, size=4, max_age=300, keepalive=30, backend=None):
+        self.size = size
+        self.max_age = max_age
+        self.keepalive = keepalive
+        self.backend = backend
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                pooled = self.idle.pop() if self.idle else None
+            if pooled is None:
+                break
+            now = time.time()
+            expired = now - pooled.created > self.max_age
+            if expired or (now - pooled.last_used > self.keepalive and not self._is_alive(pooled)):
+                self._close(pooled)
+                continue
+            pooled.reused = True
+            return pooled
+
+        return self._connect()
+
+    def release(self, pooled):
+        pooled.last_used = time.time()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(pooled)
+                return
+        self._close(pooled)
+
+    def send_messages(self, messages):
+        pooled = self.acquire()
+        sent = 0
+        try:
+            for i, message in enumerate(messages):
+                try:
+                    sent += pooled.connection.send_messages([message])
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # Only a failure on the first message of a kept open connection means nothing was delivered,
+                    # later the server may already have accepted the message it dropped on
+                    if not pooled.reused or i > 0:
+                        raise
+                    self._close(pooled)
+                    pooled = self._connect()
+                    sent += pooled.connection.send_messages([message])
+        except Exception:
+            self._close(pooled)
+            raise
+        self.release(pooled)
+        return sent
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for pooled in idle:
+            self._close(pooled)
+
+    def _connect(self):
+        connection = get_connection(self.backend)
+        connection.open()
+        return PooledConnection(connection)
+
+    def _is_alive(self, pooled):
+        smtp = getattr(pooled.connection, 'connection', None)
+        if smtp is None or not hasattr(smtp, 'noop'):
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _close(self, pooled):
+        try:
+            pooled.connection.close()
+        except Exception:
+            logger.exception('Failed to close mail connection')
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool():
+    # One pool per EMAIL_BACKEND, so connections never outlive a change of backend
+    backend = django_settings.EMAIL_BACKEND
+    with _connection_pools_lock:
+        if backend not in _connection_pools:
+            _connection_pools[backend] = ConnectionPool(size=settings.ACCOUNT_EMAIL_CONNECTION_POOL_SIZE,
+                                                        max_age=settings.ACCOUNT_EMAIL_CONNECTION_MAX_AGE,
+                                                        keepalive=settings.ACCOUNT_EMAIL_CONNECTION_KEEPALIVE,
+                                                        backend=backend)
+        return _connection_pools[backend]
+
+
+def close_connection_pools():
+    with _connection_pools_lock:
+        pools = list(_connection_pools.values())
+        _connection_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+class DispatchQueue(object):
+    """
+    Bounded queue of email messages sent by a fixed pool of worker threads.
+
+    When the queue is full, put() blocks for up to timeout seconds and then sends the messages on the calling thread,
+    so a mail server outage slows requests down instead of piling up messages in memory.
+    """
+
+    _stop = object()
+
+    def __init__(self, workers=1, maxsize=0, timeout=None):
+        self.queue = queue.Queue(maxsize)
+        self.timeout = timeout
+        self.threads = []
+        for i in range(0, workers):
+            thread = threading.Thread(target=self._work, name='slothauth-mail-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, messages):
+        try:
+            self.queue.put(messages, timeout=self.timeout)
+        except queue.Full:
+            logger.warning('Email dispatch queue is full, sending on the request thread')
+            deliver(messages)
+
+    def drain(self):
+        """ Blocks until every queued message has been sent """
+        self.queue.join()
+
+    def shutdown(self):
+        self.drain()
+        for thread in self.threads:
+            self.queue.put(self._stop)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            messages = self.queue.get()
+            try:
+                if messages is self._stop:
+                    return
+                deliver(messages)
+            except Exception:
+                logger.exception('Failed to send email to %s', ', '.join(to for msg in messages for to in msg.to))
+            finally:
+                self.queue.task_done()
+
+
+_dispatch_queue = None
+_dispatch_queue_lock = threading.Lock()
+
+
+def get_dispatch_queue():
+    global _dispatch_queue
+    if _dispatch_queue is None:
+        with _dispatch_queue_lock:
+            if _dispatch_queue is None:
+                _dispatch_queue = DispatchQueue(workers=settings.ACCOUNT_EMAIL_QUEUE_WORKERS,
+                                                maxsize=settings.ACCOUNT_EMAIL_QUEUE_SIZE,
+                                                timeout=settings.ACCOUNT_EMAIL_QUEUE_TIMEOUT)
+    return _dispatch_queue
+
+
+def shutdown_dispatch_queue():
+    """ Sends whatever is still queued and stops the workers """
+    global _dispatch_queue
+    with _dispatch_queue_lock:
+        if _dispatch_queue is not None:
+            _dispatch_queue.shutdown()
+            _dispatch_queue = None
+
+
+@atexit.register
+def shutdown():
+    shutdown_dispatch_queue()
+    close_connection_pools()
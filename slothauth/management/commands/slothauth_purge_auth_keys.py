@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ...models import AuthKey
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired AuthKeys in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of rows deleted per query')
+
+    def handle(self, *args, **options):
+        deleted = AuthKey.objects.purge_expired(chunk_size=options['chunk_size'])
+        self.stdout.write('Deleted %d expired auth keys' % deleted)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from ...bloom import BloomFilter, email_filter
+
+from ... import settings
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the Bloom filter of account emails from the accounts table and stores it in the cache'
+
+    def handle(self, *args, **options):
+        generation, bits, count = email_filter.rebuild()
+        bloom = BloomFilter(settings.ACCOUNT_EMAIL_BLOOM_FILTER_CAPACITY,
+                            settings.ACCOUNT_EMAIL_BLOOM_FILTER_ERROR_RATE, bits=bits, count=count)
+        self.stdout.write('Added %d emails, %d bytes, expected false positive rate %.4f' %
+                          (count, len(bits), bloom.false_positive_rate))
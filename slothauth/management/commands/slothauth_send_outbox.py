@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import EmailOutbox
+
+
+class Command(BaseCommand):
+    help = 'Sends emails written to the EmailOutbox table in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of emails claimed and sent over one connection')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling for new emails instead of exiting once the outbox is empty')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait between polls when the outbox is empty')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            try:
+                sent = EmailOutbox.objects.send_pending(batch_size=options['batch_size'])
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                # Keep the sender running through database outages, the batch is retried after the interval
+                self.stderr.write('Failed to send outbox emails: %s' % e)
+                sent = 0
+            total += sent
+            if not sent:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write('Processed %d outbox emails' % total)
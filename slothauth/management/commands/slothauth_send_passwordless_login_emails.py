@@ -0,0 +1,41 @@
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+
+Account = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Sends a login link to every active passwordless account'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of accounts loaded, rendered and sent at a time')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of threads rendering emails')
+        parser.add_argument('--checkpoint-file',
+                            help='File recording the last account handled. An interrupted run started again with '
+                                 'the same file resumes after that account.')
+
+    def handle(self, *args, **options):
+        checkpoint_file = options['checkpoint_file']
+        start_after = None
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                start_after = int(f.read().strip())
+            self.stdout.write('Resuming after account %d' % start_after)
+
+        def checkpoint(last_pk, sent):
+            if checkpoint_file:
+                # Write then rename, so a crash never leaves a half written checkpoint
+                with open(checkpoint_file + '.tmp', 'w') as f:
+                    f.write(str(last_pk))
+                os.replace(checkpoint_file + '.tmp', checkpoint_file)
+            self.stdout.write('Sent %d emails, up to account %d' % (sent, last_pk))
+
+        sent = Account.objects.filter(is_active=True).send_passwordless_login_emails(
+            chunk_size=options['chunk_size'], workers=options['workers'], start_after=start_after,
+            checkpoint=checkpoint)
+        self.stdout.write('Sent %d passwordless login emails' % sent)
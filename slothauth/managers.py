@@ -1,7 +1,81 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from django.contrib.auth import models
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.core.mail import get_connection
+from django.db import connections, router, transaction
+from django.db.models import F, Manager, Q, QuerySet
+from django.utils import timezone
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+
+class AccountQuerySet(QuerySet):
+    def bulk_create(self, *args, **kwargs):
+        accounts = super(AccountQuerySet, self).bulk_create(*args, **kwargs)
+        # No post_save is sent, so the email Bloom filter can't learn the new emails
+        invalidate_email_filter(self.db)
+        return accounts
+
+    def update(self, **kwargs):
+        rows = super(AccountQuerySet, self).update(**kwargs)
+        if 'email' in kwargs:
+            invalidate_email_filter(self.db)
+        return rows
+
+    def passwordless(self):
+        """ Accounts that log in with their passwordless key, the database side of SlothAuthBaseUser.is_passwordless """
+        return self.exclude(passwordless_key='').filter(Q(password__startswith=UNUSABLE_PASSWORD_PREFIX) |
+                                                        Q(password__isnull=True) | Q(password=''))
+
+    def chunks(self, chunk_size=500, start_after=None):
+        """
+        Yields lists of at most chunk_size accounts in primary key order, fetching one chunk per query so memory use
+        doesn't grow with the size of the queryset. start_after skips every account up to and including that pk.
+        """
+        queryset = self.order_by('pk')
+        while True:
+            chunk = list((queryset.filter(pk__gt=start_after) if start_after is not None else queryset)[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            start_after = chunk[-1].pk
+
+    def send_passwordless_login_emails(self, chunk_size=500, workers=4, start_after=None, checkpoint=None):
+        """
+        Sends a login link to every passwordless account in the queryset, chunk by chunk. Emails of a chunk are
+        rendered by a pool of worker threads and sent together with send_many. After each chunk, checkpoint (if
+        given) is called with the pk of the last account handled and the number of emails sent so far, so an
+        interrupted run can be resumed with start_after. Returns the number of emails sent.
+        """
+        from .mail import send_many
+
+        sent = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk in self.passwordless().chunks(chunk_size=chunk_size, start_after=start_after):
+                accounts = [account for account in chunk if account.is_passwordless]
+                # Keys are fetched here, rendering in the workers doesn't touch the database
+                contexts = [account.get_passwordless_login_email_context() for account in accounts]
+                messages = list(executor.map(lambda args: args[0].make_passwordless_login_email(args[1]),
+                                             zip(accounts, contexts)))
+                send_many(messages)
+                sent += len(messages)
+                if checkpoint is not None:
+                    checkpoint(chunk[-1].pk, sent)
+        return sent
+
+
+def invalidate_email_filter(using):
+    if settings.ACCOUNT_EMAIL_BLOOM_FILTER:
+        from .bloom import email_filter
+        email_filter.invalidate(using=using)
 
 
-class UserManager(models.UserManager):
+class UserManager(models.UserManager.from_queryset(AccountQuerySet)):
     def create_user(self, email, password=None, **kwargs):
         user = self.model(email=email, **kwargs)
         user.set_password(password)
@@ -13,3 +87,86 @@ class UserManager(models.UserManager):
         user.set_password(password)
         user.save()
         return user
+
+
+class AuthKeyManager(Manager):
+    def issue(self, user, kind, ttl=None):
+        if ttl is None:
+            ttl = settings.ACCOUNT_AUTH_KEY_TTL.get(kind)
+        expires_at = timezone.now() + timedelta(seconds=ttl) if ttl is not None else None
+        return self.create(user=user, kind=kind, expires_at=expires_at)
+
+    def valid(self):
+        return self.filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+
+    def get_user(self, key, kind):
+        # A single probe on the unique key index, joined to the user row
+        auth_key = self.valid().filter(key=key, kind=kind).select_related('user').first()
+        return auth_key.user if auth_key else None
+
+    def consume(self, key, kind, user=None):
+        """ Deletes the key and returns its user. With user given, a key belonging to someone else is left alone. """
+        auth_keys = self.valid().filter(key=key, kind=kind)
+        if user is not None:
+            auth_keys = auth_keys.filter(user=user)
+        auth_key = auth_keys.select_related('user').first()
+        # Whoever deletes the row owns the key, so concurrent uses of the same key can't both succeed
+        if auth_key and self.filter(pk=auth_key.pk).delete()[0]:
+            return auth_key.user
+        return None
+
+    def purge_expired(self, chunk_size=1000):
+        deleted = 0
+        while True:
+            pks = list(self.filter(expires_at__lte=timezone.now()).values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return deleted
+            deleted += self.filter(pk__in=pks).delete()[0]
+
+
+class EmailOutboxManager(Manager):
+    def pending(self):
+        return self.filter(sent_at__isnull=True, attempts__lt=settings.ACCOUNT_EMAIL_OUTBOX_MAX_ATTEMPTS)
+
+    def send_pending(self, batch_size=100):
+        """
+        Claims up to batch_size unsent emails and sends them over one mail connection. Rows are locked with
+        SKIP LOCKED where the database supports it, so several senders can run side by side. Returns the number of
+        emails claimed, or 0 when the mail connection couldn't be opened so callers back off before retrying.
+        """
+        using = router.db_for_write(self.model)
+        features = connections[using].features
+        with transaction.atomic(using=using):
+            pending = self.pending().using(using).order_by('pk')
+            if features.has_select_for_update_skip_locked:
+                pending = pending.select_for_update(skip_locked=True)
+            elif features.has_select_for_update:
+                pending = pending.select_for_update()
+            emails = list(pending[:batch_size])
+            if not emails:
+                return 0
+
+            connection = get_connection()
+            try:
+                connection.open()
+            except Exception as e:
+                # The mail server is down, not the emails at fault, so no attempt is used up
+                logger.exception('Failed to open mail connection for outbox emails')
+                self.using(using).filter(pk__in=[email.pk for email in emails]).update(last_error=str(e))
+                return 0
+
+            sent = []
+            try:
+                for email in emails:
+                    try:
+                        email.to_message(connection=connection).send()
+                        sent.append(email.pk)
+                    except Exception as e:
+                        self.using(using).filter(pk=email.pk).update(attempts=F('attempts') + 1, last_error=str(e))
+            finally:
+                try:
+                    connection.close()
+                except Exception:
+                    logger.exception('Failed to close mail connection')
+            self.using(using).filter(pk__in=sent).update(sent_at=timezone.now(), attempts=F('attempts') + 1)
+        return len(emails)
@@ -1,17 +1,111 @@
-from django.contrib.auth import authenticate, login
+import asyncio
+import functools
+
+from django.conf import settings as django_settings
+from django.contrib import auth
+from django.contrib.auth import HASH_SESSION_KEY, authenticate, login, load_backend
 from django.contrib.auth import get_user_model
+from django.contrib.auth.middleware import AuthenticationMiddleware as DjangoAuthenticationMiddleware
+from django.utils.functional import SimpleLazyObject
+
+from .backends import PasswordlessAuthentication, get_authentication_executor, run_in_worker, session_auth_hash
+from .exceptions import SlothAuthInvalidSetting
+from .utils import get_shared_cache, instance_from_row, instance_to_row
 
 from . import settings
 
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    from inspect import iscoroutinefunction
+    try:
+        from inspect import markcoroutinefunction
+    except ImportError:
+        # Django's ASGI handler depends on asgiref, without it there is no async caller to mark ourselves for
+        markcoroutinefunction = None
+
 
 Account = get_user_model()
 
 
-class PasswordlessUserMiddleware(object):
+async def run_sync(function, *args, **kwargs):
+    """ Runs a blocking function, like an ORM query, in the authentication worker pool """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_authentication_executor(),
+                                      functools.partial(run_in_worker, function, *args, **kwargs))
+
+
+async def aauthenticate(**credentials):
+    try:
+        from django.contrib.auth import aauthenticate as django_aauthenticate
+    except ImportError:
+        return await run_sync(authenticate, **credentials)
+    return await django_aauthenticate(**credentials)
+
+
+async def alogin(request, user):
+    try:
+        from django.contrib.auth import alogin as django_alogin
+    except ImportError:
+        return await run_sync(login, request, user)
+    return await django_alogin(request, user)
+
+
+class AuthenticationMiddleware(DjangoAuthenticationMiddleware):
+    """
+    Django's AuthenticationMiddleware, passing the session's password hash on to PasswordlessAuthentication.get_user,
+    so ACCOUNT_USER_CACHE entries are keyed on it and a password change misses the cache
+    """
+
+    def process_request(self, request):
+        super(AuthenticationMiddleware, self).process_request(request)
+        request.user = SimpleLazyObject(lambda: get_session_user(request))
+
+
+def get_session_user(request):
+    if not hasattr(request, '_cached_user'):
+        with session_auth_hash(request.session.get(HASH_SESSION_KEY)):
+            request._cached_user = auth.get_user(request)
+    return request._cached_user
+
+
+class AsyncCapableMiddleware(object):
+    """
+    Base for middleware that runs natively under both WSGI and ASGI. Subclasses implement process_request and
+    aprocess_request. The async path only leaves the event loop when there is actual work to do, so requests without
+    a key don't pay for a thread hop.
+    """
+
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.is_async = markcoroutinefunction is not None and iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        self.process_request(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        await self.aprocess_request(request)
+        return await self.get_response(request)
+
+    def process_request(self, request):
+        pass
+
+    async def aprocess_request(self, request):
+        # Subclasses override this to skip the thread hop when there is nothing to do
+        await run_sync(self.process_request, request)
+
+
+class PasswordlessUserMiddleware(AsyncCapableMiddleware):
+
+    def process_request(self, request):
         passwordless_key = request.GET.get(settings.PASSWORDLESS_GET_PARAM, None)
         if passwordless_key and not (passwordless_key == ''):
             user = authenticate(passwordless_key=passwordless_key,
@@ -19,42 +113,130 @@ class PasswordlessUserMiddleware(object):
             if user and user.is_active:
                 login(request, user)
 
-        response = self.get_response(request)
-
-        return response
+    async def aprocess_request(self, request):
+        passwordless_key = request.GET.get(settings.PASSWORDLESS_GET_PARAM, None)
+        if passwordless_key and not (passwordless_key == ''):
+            user = await aauthenticate(passwordless_key=passwordless_key, force=True)
+            if user and user.is_active:
+                await alogin(request, user)
 
 
-class OneTimeAuthenticationKeyMiddleware(object):
-    def __init__(self, get_response):
-        self.get_response = get_response
+class OneTimeAuthenticationKeyMiddleware(AsyncCapableMiddleware):
 
-    def __call__(self, request):
+    def process_request(self, request):
         one_time_authentication_key = request.GET.get(settings.ONE_TIME_AUTHENTICATION_KEY_GET_PARAM, None)
         if one_time_authentication_key and not (one_time_authentication_key == ''):
             user = authenticate(one_time_authentication_key=one_time_authentication_key)
             if user and user.is_active:
                 login(request, user)
 
-        response = self.get_response(request)
-
-        return response
-
+    async def aprocess_request(self, request):
+        one_time_authentication_key = request.GET.get(settings.ONE_TIME_AUTHENTICATION_KEY_GET_PARAM, None)
+        if one_time_authentication_key and not (one_time_authentication_key == ''):
+            user = await aauthenticate(one_time_authentication_key=one_time_authentication_key)
+            if user and user.is_active:
+                await alogin(request, user)
+
+
+class ImpersonateMiddleware(AsyncCapableMiddleware):
+
+    def process_request(self, request):
+        process_impersonation(request)
+
+    async def aprocess_request(self, request):
+        # Loading the session or request.user hits the database, so only the cookie and the query string are looked
+        # at on the event loop. A lazy user could not be resolved on the event loop later either.
+        if django_settings.SESSION_COOKIE_NAME in request.COOKIES or '__impersonate' in request.GET:
+            await run_sync(process_impersonation, request, lazy=False)
+
+
+def process_impersonation(request, lazy=True):
+    # The session and query string are checked first, they are cheaper than loading request.user
+    impersonating = 'impersonate_id' in request.session
+    if not impersonating and "__impersonate" not in request.GET:
+        return
+    if not (getattr(request.user, 'can_impersonate', False) or getattr(request.user, 'is_superuser', False)):
+        return
+
+    if "__unimpersonate" in request.GET:
+        if impersonating:
+            del request.session['impersonate_id']
+        return
+    if "__impersonate" in request.GET:
+        request.session['impersonate_id'] = int(request.GET["__impersonate"])
+    # The account is only fetched if the request actually uses request.user
+    user_id = request.session['impersonate_id']
+    request.user = SimpleLazyObject(lambda: get_impersonated_user(user_id)) if lazy else get_impersonated_user(user_id)
+
+
+def get_impersonated_user(user_id):
+    """
+    Returns the account with id user_id, from the ACCOUNT_IMPERSONATE_CACHE cache if it is set. The cache holds field
+    values rather than instances, so every request gets its own instance.
+    """
+    if not settings.ACCOUNT_IMPERSONATE_CACHE:
+        return Account.objects.get(id=user_id)
+    cache = get_impersonate_cache()
+    key = 'slothauth:impersonate:%s' % user_id
+    row = cache.get(key)
+    if row is None:
+        user = Account.objects.get(id=user_id)
+        cache.set(key, instance_to_row(user), settings.ACCOUNT_IMPERSONATE_CACHE_TIMEOUT)
+        return user
+    return instance_from_row(Account, row)
+
+
+def get_impersonate_cache():
+    # Saves have to evict the account in every process, or a stale copy could be saved back over them
+    return get_shared_cache(settings.ACCOUNT_IMPERSONATE_CACHE, 'ACCOUNT_IMPERSONATE_CACHE')
+
+
+def invalidate_impersonated_user(user_id):
+    if settings.ACCOUNT_IMPERSONATE_CACHE:
+        get_impersonate_cache().delete('slothauth:impersonate:%s' % user_id)
+
+
+def get_passwordless_backend():
+    """ Returns the first configured PasswordlessAuthentication backend and its path """
+    for backend_path in django_settings.AUTHENTICATION_BACKENDS:
+        backend = load_backend(backend_path)
+        if isinstance(backend, PasswordlessAuthentication):
+            return backend, backend_path
+    raise SlothAuthInvalidSetting('AUTHENTICATION_BACKENDS must include slothauth.backends.PasswordlessAuthentication')
+
+
+class AuthKeyMiddleware(AsyncCapableMiddleware):
+    """
+    Replaces PasswordlessUserMiddleware, OneTimeAuthenticationKeyMiddleware and ImpersonateMiddleware, and goes after
+    AuthenticationMiddleware. The query string is read once and a key is resolved by the PasswordlessAuthentication
+    backend directly, with a single query, rather than by every configured backend. Requests without a key or an
+    impersonation return right away.
+    """
 
-class ImpersonateMiddleware(object):
     def __init__(self, get_response):
-        self.get_response = get_response
-
-    def __call__(self, request):
-        if (hasattr(request.user, 'can_impersonate') and request.user.can_impersonate) or\
-           (hasattr(request.user, 'is_superuser') and request.user.is_superuser):
-            if 'impersonate_id' in request.session:
-                request.user = Account.objects.get(id=request.session['impersonate_id'])
-            elif "__impersonate" in request.GET:
-                request.session['impersonate_id'] = int(request.GET["__impersonate"])
-                request.user = Account.objects.get(id=request.session['impersonate_id'])
-            elif "__unimpersonate" in request.GET and 'impersonate_id' in request.session:
-                del request.session['impersonate_id']
-
-        response = self.get_response(request)
-
-        return response
+        super(AuthKeyMiddleware, self).__init__(get_response)
+        self.backend, self.backend_path = get_passwordless_backend()
+        self.passwordless_param = settings.PASSWORDLESS_GET_PARAM
+        self.one_time_authentication_key_param = settings.ONE_TIME_AUTHENTICATION_KEY_GET_PARAM
+
+    def process_request(self, request, lazy=True):
+        if request.GET:
+            self.process_keys(request)
+        process_impersonation(request, lazy=lazy)
+
+    async def aprocess_request(self, request):
+        # Session lookups block, only leave the event loop when there is a query string or a session to look at
+        if request.GET or django_settings.SESSION_COOKIE_NAME in request.COOKIES:
+            await run_sync(self.process_request, request, lazy=False)
+
+    def process_keys(self, request):
+        user = None
+        passwordless_key = request.GET.get(self.passwordless_param)
+        if passwordless_key:
+            user = self.backend.get_user_by_passwordless_key(passwordless_key)
+        else:
+            one_time_authentication_key = request.GET.get(self.one_time_authentication_key_param)
+            if one_time_authentication_key:
+                user = self.backend.get_user_by_one_time_authentication_key(one_time_authentication_key)
+        if user and user.is_active:
+            login(request, user, backend=self.backend_path)
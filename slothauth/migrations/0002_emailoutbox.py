@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slothauth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.TextField(verbose_name='subject')),
+                ('body', models.TextField(blank=True, verbose_name='body')),
+                ('html', models.TextField(blank=True, verbose_name='html')),
+                ('from_email', models.CharField(blank=True, max_length=254, verbose_name='from email')),
+                ('to', models.TextField(help_text='One recipient per line.', verbose_name='to')),
+                ('headers', models.TextField(default='{}', verbose_name='headers')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+                ('sent_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='sent at')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+            ],
+        ),
+    ]
@@ -1,14 +1,17 @@
 from __future__ import unicode_literals
 
+import json
+
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
-from django.db import models
-from django.template.loader import render_to_string
+from django.core.mail import EmailMultiAlternatives
+from django.db import IntegrityError, models, router, transaction
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from .mail import send_mail
-from .managers import UserManager
-from .utils import RandomField, CiEmailField
+from .mail import passwordless_login_coalescer, render_mail, send_many
+from .managers import AuthKeyManager, EmailOutboxManager, UserManager
+from .signed_keys import make_signed_key
+from .utils import RandomField, CiEmailField, find_random_field_collisions, get_random_fields
 
 from . import settings
 
@@ -32,9 +35,11 @@ class SlothAuthBaseUser(AbstractBaseUser, PermissionsMixin):
 
     # Passwordless fields
 
-    passwordless_key = RandomField(max_length=32, blank=True)
-    one_time_authentication_key = RandomField(max_length=32, blank=True)
-    password_reset_key = RandomField(max_length=32, blank=True)
+    passwordless_key = RandomField(max_length=32, blank=True, unique=settings.ACCOUNT_KEYS_UNIQUE)
+    one_time_authentication_key = RandomField(max_length=32, blank=True, unique=settings.ACCOUNT_KEYS_UNIQUE)
+    password_reset_key = RandomField(max_length=32, blank=True, unique=settings.ACCOUNT_KEYS_UNIQUE)
+    auth_key_version = models.PositiveIntegerField(_('auth key version'), default=0,
+                                                   help_text=_('Signed keys issued for an older version are rejected.'))
 
     # Impersonate fields
 
@@ -59,6 +64,65 @@ class SlothAuthBaseUser(AbstractBaseUser, PermissionsMixin):
 
     # Methods
 
+    def save(self, *args, **kwargs):
+        # Unique keys are generated without checking the table first, so a collision surfaces as an IntegrityError.
+        # Regenerate the colliding keys and try again.
+        update_fields = kwargs.get('update_fields')
+        fresh_fields = [field for field in get_random_fields(type(self), update_fields)
+                        if field.unique and not getattr(self, field.attname)]
+        if not fresh_fields:
+            return super(SlothAuthBaseUser, self).save(*args, **kwargs)
+
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        for i in range(0, RandomField.MAX_LOOPS):
+            try:
+                if transaction.get_connection(using).in_atomic_block:
+                    # A failed INSERT would break the surrounding transaction, so it costs a savepoint there. In
+                    # autocommit mode the INSERT is its own transaction and nothing needs rolling back.
+                    with transaction.atomic(using=using):
+                        return super(SlothAuthBaseUser, self).save(*args, **kwargs)
+                return super(SlothAuthBaseUser, self).save(*args, **kwargs)
+            except IntegrityError:
+                collisions = find_random_field_collisions(self, fresh_fields)
+                if not collisions:
+                    raise
+                for field in collisions:
+                    setattr(self, field.attname, '')
+        raise IntegrityError("Could not generate unique keys for %s" % type(self).__name__)
+
+    def get_passwordless_key(self):
+        if settings.ACCOUNT_SIGNED_KEYS:
+            return make_signed_key(self, AuthKey.PASSWORDLESS)
+        if settings.ACCOUNT_AUTH_KEYS:
+            return AuthKey.objects.issue(self, AuthKey.PASSWORDLESS).key
+        return self.passwordless_key
+
+    def get_one_time_authentication_key(self):
+        if settings.ACCOUNT_SIGNED_KEYS:
+            return make_signed_key(self, AuthKey.ONE_TIME_AUTHENTICATION)
+        if settings.ACCOUNT_AUTH_KEYS:
+            return AuthKey.objects.issue(self, AuthKey.ONE_TIME_AUTHENTICATION).key
+        return self.one_time_authentication_key
+
+    def get_password_reset_key(self):
+        if settings.ACCOUNT_AUTH_KEYS:
+            return AuthKey.objects.issue(self, AuthKey.PASSWORD_RESET).key
+        return self.password_reset_key
+
+    def update(self, **values):
+        """ Sets the given fields and saves the ones whose value changed, only those columns are written """
+        changed = [name for name, value in values.items() if getattr(self, name) != value]
+        for name in changed:
+            setattr(self, name, values[name])
+        if changed:
+            self.save(update_fields=changed)
+        return changed
+
+    def revoke_signed_keys(self):
+        """ Invalidates every signed key issued to the account so far """
+        self.auth_key_version += 1
+        self.save(update_fields=['auth_key_version'])
+
     def get_short_name(self):
         return self.first_name
 
@@ -75,13 +139,81 @@ class SlothAuthBaseUser(AbstractBaseUser, PermissionsMixin):
             }
             form.save(**opts)
 
+    def get_passwordless_login_email_context(self):
+        return {'domain': settings.ACCOUNT_EMAIL_DOMAIN,
+                'protocol': 'http',
+                'passwordless_key': self.get_passwordless_key()}
+
+    def make_passwordless_login_email(self, context):
+        return render_mail(settings.ACCOUNT_EMAIL_PASSWORDLESS_LOGIN_SUBJECT,
+                           'slothauth/passwordless_login_email.txt',
+                           'slothauth/passwordless_login_email.html',
+                           context,
+                           settings.ACCOUNT_EMAIL_FROM,
+                           self.email)
+
     def send_passwordless_login_email(self):
-        if self.is_passwordless:
-            context = {'domain': settings.ACCOUNT_EMAIL_DOMAIN,
-                       'protocol': 'http',
-                       'passwordless_key': self.passwordless_key}
-            send_mail(settings.ACCOUNT_EMAIL_PASSWORDLESS_LOGIN_SUBJECT,
-                      render_to_string('slothauth/passwordless_login_email.txt', context),
-                      render_to_string('slothauth/passwordless_login_email.html', context),
-                      settings.ACCOUNT_EMAIL_FROM,
-                      self.email)
+        # Double clicks and client retries inside the coalescing window don't send another copy
+        if self.is_passwordless and passwordless_login_coalescer.claim(self.pk):
+            try:
+                send_many([self.make_passwordless_login_email(self.get_passwordless_login_email_context())])
+            except Exception:
+                # Let the retry through
+                passwordless_login_coalescer.release(self.pk)
+                raise
+
+
+class AuthKey(models.Model):
+
+    PASSWORDLESS = 'passwordless'
+    ONE_TIME_AUTHENTICATION = 'one_time_authentication'
+    PASSWORD_RESET = 'password_reset'
+
+    KIND_CHOICES = (
+        (PASSWORDLESS, _('passwordless')),
+        (ONE_TIME_AUTHENTICATION, _('one time authentication')),
+        (PASSWORD_RESET, _('password reset')),
+    )
+
+    kind = models.CharField(_('kind'), max_length=32, choices=KIND_CHOICES)
+    key = RandomField(max_length=32, unique=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='auth_keys')
+    created = models.DateTimeField(_('created'), default=timezone.now)
+    expires_at = models.DateTimeField(_('expires at'), null=True, blank=True, db_index=True)
+
+    # Manager
+
+    objects = AuthKeyManager()
+
+
+class EmailOutbox(models.Model):
+
+    subject = models.TextField(_('subject'))
+    body = models.TextField(_('body'), blank=True)
+    html = models.TextField(_('html'), blank=True)
+    from_email = models.CharField(_('from email'), max_length=254, blank=True)
+    to = models.TextField(_('to'), help_text=_('One recipient per line.'))
+    headers = models.TextField(_('headers'), default='{}')
+    created = models.DateTimeField(_('created'), default=timezone.now)
+    sent_at = models.DateTimeField(_('sent at'), null=True, blank=True, db_index=True)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    # Manager
+
+    objects = EmailOutboxManager()
+
+    # Methods
+
+    @classmethod
+    def from_message(cls, msg):
+        html = ''.join(content for content, mimetype in msg.alternatives if mimetype == 'text/html')
+        return cls(subject=msg.subject, body=msg.body, html=html, from_email=msg.from_email or '',
+                   to='\n'.join(msg.to), headers=json.dumps(msg.extra_headers))
+
+    def to_message(self, connection=None):
+        msg = EmailMultiAlternatives(subject=self.subject, body=self.body, from_email=self.from_email or None,
+                                     to=self.to.splitlines(), headers=json.loads(self.headers), connection=connection)
+        if self.html:
+            msg.attach_alternative(self.html, "text/html")
+        return msg
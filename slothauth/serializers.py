@@ -1,7 +1,12 @@
+from collections import OrderedDict
+
 from rest_framework import serializers
+from rest_framework.authtoken.models import Token
 
 from django.contrib.auth import get_user_model
 
+from . import settings
+
 
 Account = get_user_model()
 
@@ -26,4 +31,35 @@ class AccountSerializer(serializers.ModelSerializer):
         fields = ('id', 'email', 'auth_token', 'first_name', 'last_name', )
 
     def get_auth_token(self, obj):
-        return obj.auth_token.key
+        return get_auth_token_key(obj)
+
+
+def get_auth_token_key(account):
+    # Served from select_related('auth_token') when the account was loaded with it
+    try:
+        return account.auth_token.key
+    except Token.DoesNotExist:
+        # Lazy tokens only exist once asked for through the auth_token endpoint
+        if settings.ACCOUNT_LAZY_AUTH_TOKEN:
+            return None
+        raise
+
+
+class FastAccountSerializer(object):
+    """
+    Serializes a single account to the same data as AccountSerializer, reading model attributes directly instead of
+    going through DRF's field machinery. Used for the login and /accounts/me responses.
+    """
+
+    # Model attribute of each AccountSerializer field, looked up once
+    fields = [(name, Account._meta.get_field(name).attname if name != 'auth_token' else None)
+              for name in AccountSerializer.Meta.fields]
+
+    def __init__(self, instance):
+        self.instance = instance
+
+    @property
+    def data(self):
+        account = self.instance
+        return OrderedDict((name, getattr(account, attname) if attname else get_auth_token_key(account))
+                           for name, attname in self.fields)
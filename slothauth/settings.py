@@ -1,3 +1,4 @@
+import os
 import warnings
 
 from django.conf import settings
@@ -15,10 +16,77 @@ PASSWORDLESS_GET_PARAM = getattr(settings, 'PASSWORDLESS_GET_PARAM', 'key')
 
 ONE_TIME_AUTHENTICATION_KEY_GET_PARAM = getattr(settings, 'ONE_TIME_AUTHENTICATION_KEY_GET_PARAM', 'otk')
 
+# When True, the passwordless, one time authentication and password reset keys get a unique index and are generated
+# without pre-check queries. Run makemigrations on your user app after changing this.
+ACCOUNT_KEYS_UNIQUE = getattr(settings, 'ACCOUNT_KEYS_UNIQUE', False)
+
+# When True, passwordless, one time authentication and password reset keys are issued as rows of the AuthKey table
+# instead of being read from the user row
+ACCOUNT_AUTH_KEYS = getattr(settings, 'ACCOUNT_AUTH_KEYS', False)
+
+# Lifetime in seconds of each kind of AuthKey or signed key, None means the key never expires
+ACCOUNT_AUTH_KEY_TTL = getattr(settings, 'ACCOUNT_AUTH_KEY_TTL', {
+    'passwordless': 60 * 60 * 24 * 30,
+    'one_time_authentication': 60 * 60 * 24,
+    'password_reset': 60 * 60 * 24,
+})
+
+# Hand out signed passwordless and one time authentication keys that are verified without a lookup. Takes precedence
+# over ACCOUNT_AUTH_KEYS, and keys of the other kinds stop working when it is turned on
+ACCOUNT_SIGNED_KEYS = getattr(settings, 'ACCOUNT_SIGNED_KEYS', False)
+
+# Threads checking password hashes for PasswordlessAuthentication.aauthenticate
+ACCOUNT_AUTHENTICATION_WORKERS = getattr(settings, 'ACCOUNT_AUTHENTICATION_WORKERS', os.cpu_count() or 1)
+
+# Name of a Django cache shared by all processes, holding the accounts of session authenticated requests. None turns
+# the cache off
+ACCOUNT_USER_CACHE = getattr(settings, 'ACCOUNT_USER_CACHE', None)
+
+# Seconds an account stays in ACCOUNT_USER_CACHE
+ACCOUNT_USER_CACHE_TIMEOUT = getattr(settings, 'ACCOUNT_USER_CACHE_TIMEOUT', 300)
+
+# Number of recently failed passwordless and one time authentication keys each process remembers, so repeats of them
+# are turned away without a query. 0 turns the cache off
+ACCOUNT_FAILED_KEY_CACHE_SIZE = getattr(settings, 'ACCOUNT_FAILED_KEY_CACHE_SIZE', 0)
+
+# Seconds a failed key is remembered
+ACCOUNT_FAILED_KEY_CACHE_TIMEOUT = getattr(settings, 'ACCOUNT_FAILED_KEY_CACHE_TIMEOUT', 60)
+
+# Keep a Bloom filter of account emails in memory, so login and signup attempts for unknown emails skip the database
+ACCOUNT_EMAIL_BLOOM_FILTER = getattr(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER', False)
+
+# Number of accounts the Bloom filter is sized for, and its false positive rate at that size
+ACCOUNT_EMAIL_BLOOM_FILTER_CAPACITY = getattr(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER_CAPACITY', 1000000)
+ACCOUNT_EMAIL_BLOOM_FILTER_ERROR_RATE = getattr(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER_ERROR_RATE', 0.01)
+
+# Name of a Django cache shared by all processes, holding the Bloom filter snapshot and the count of emails saved since
+ACCOUNT_EMAIL_BLOOM_FILTER_CACHE = getattr(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER_CACHE', None)
+
+# Minimum seconds between a process's background reloads of a stale filter, it uses the database for misses meanwhile
+ACCOUNT_EMAIL_BLOOM_FILTER_REFRESH = getattr(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER_REFRESH', 300)
+
+# Create API tokens when they are first asked for through the auth_token endpoint, instead of for every new account
+ACCOUNT_LAZY_AUTH_TOKEN = getattr(settings, 'ACCOUNT_LAZY_AUTH_TOKEN', False)
+
+# Name of a Django cache shared by all processes, holding token to user lookups for CachedTokenAuthentication
+ACCOUNT_TOKEN_CACHE = getattr(settings, 'ACCOUNT_TOKEN_CACHE', None)
+
+# Seconds a token stays cached, and so how long changes made without save() or delete() take to be seen
+ACCOUNT_TOKEN_CACHE_TIMEOUT = getattr(settings, 'ACCOUNT_TOKEN_CACHE_TIMEOUT', 300)
+
+# Name of a Django cache shared by all processes, holding impersonated accounts. None turns the cache off
+ACCOUNT_IMPERSONATE_CACHE = getattr(settings, 'ACCOUNT_IMPERSONATE_CACHE', None)
+
+# Seconds an impersonated account is cached for
+ACCOUNT_IMPERSONATE_CACHE_TIMEOUT = getattr(settings, 'ACCOUNT_IMPERSONATE_CACHE_TIMEOUT', 300)
+
 API_VERSION = getattr(settings, 'API_VERSION', 'v1')
 
 ACCOUNT_FORM = getattr(settings, 'ACCOUNT_FORM', 'slothauth.forms.AccountForm')
 
+# Let AccountForm rely on the unique email index instead of checking the email with a query before saving
+ACCOUNT_FORM_OPTIMISTIC_EMAIL = getattr(settings, 'ACCOUNT_FORM_OPTIMISTIC_EMAIL', False)
+
 # Domain for links in email templates
 ACCOUNT_EMAIL_DOMAIN = getattr(settings, 'ACCOUNT_EMAIL_DOMAIN', 'example.com')
 
@@ -28,6 +96,39 @@ ACCOUNT_EMAIL_PASSWORD_RESET_SUBJECT = getattr(settings, 'ACCOUNT_EMAIL_PASSWORD
 
 ACCOUNT_EMAIL_PASSWORDLESS_LOGIN_SUBJECT = getattr(settings, 'ACCOUNT_EMAIL_PASSWORDLESS_LOGIN_SUBJECT', 'Your Login Link')
 
+# Seconds during which repeated passwordless login emails to the same account are dropped, 0 turns coalescing off
+ACCOUNT_EMAIL_COALESCE_WINDOW = getattr(settings, 'ACCOUNT_EMAIL_COALESCE_WINDOW', 0)
+
+# Name of the Django cache that remembers recently sent emails
+ACCOUNT_EMAIL_COALESCE_CACHE = getattr(settings, 'ACCOUNT_EMAIL_COALESCE_CACHE', 'default')
+
+# Keep mail connections open between emails instead of connecting for every one
+ACCOUNT_EMAIL_CONNECTION_POOL = getattr(settings, 'ACCOUNT_EMAIL_CONNECTION_POOL', True)
+
+ACCOUNT_EMAIL_CONNECTION_POOL_SIZE = getattr(settings, 'ACCOUNT_EMAIL_CONNECTION_POOL_SIZE', 4)
+
+# Seconds after which a pooled connection is closed and replaced
+ACCOUNT_EMAIL_CONNECTION_MAX_AGE = getattr(settings, 'ACCOUNT_EMAIL_CONNECTION_MAX_AGE', 300)
+
+# Seconds a pooled connection can sit idle before it is checked with a NOOP before reuse
+ACCOUNT_EMAIL_CONNECTION_KEEPALIVE = getattr(settings, 'ACCOUNT_EMAIL_CONNECTION_KEEPALIVE', 30)
+
+# Write emails to the EmailOutbox table, to be sent by the slothauth_send_outbox management command
+ACCOUNT_EMAIL_OUTBOX = getattr(settings, 'ACCOUNT_EMAIL_OUTBOX', False)
+
+# Number of failed attempts after which an outbox email is no longer retried
+ACCOUNT_EMAIL_OUTBOX_MAX_ATTEMPTS = getattr(settings, 'ACCOUNT_EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+
+# Send emails from a pool of background threads instead of the request thread
+ACCOUNT_EMAIL_QUEUE = getattr(settings, 'ACCOUNT_EMAIL_QUEUE', False)
+
+ACCOUNT_EMAIL_QUEUE_WORKERS = getattr(settings, 'ACCOUNT_EMAIL_QUEUE_WORKERS', 2)
+
+ACCOUNT_EMAIL_QUEUE_SIZE = getattr(settings, 'ACCOUNT_EMAIL_QUEUE_SIZE', 1000)
+
+# Seconds to wait for room when the queue is full before sending on the request thread
+ACCOUNT_EMAIL_QUEUE_TIMEOUT = getattr(settings, 'ACCOUNT_EMAIL_QUEUE_TIMEOUT', 5)
+
 # Authentication
 
 AUTHENTICATION_BACKENDS = [
@@ -1,9 +1,14 @@
-from django.db.models.signals import post_save
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 from rest_framework.authtoken.models import Token
 
-from .utils import disable_for_loaddata
+from .authentication import token_cache
+from .bloom import email_filter
+from .backends import invalidate_cached_user
+from .middleware import invalidate_impersonated_user
+from .utils import disable_for_loaddata, failed_keys, get_random_fields
 
 from . import settings
 
@@ -11,5 +16,34 @@ from . import settings
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 @disable_for_loaddata
 def create_auth_token(sender, instance=None, created=False, **kwargs):
-    if created:
+    if created and not settings.ACCOUNT_LAZY_AUTH_TOKEN:
         Token.objects.create(user=instance)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_account(sender, instance=None, **kwargs):
+    invalidate_impersonated_user(instance.pk)
+    invalidate_cached_user(instance.pk)
+    token_cache.delete_user(instance.pk)
+    # Keys can also be set by hand, rather than generated
+    for field in get_random_fields(sender):
+        failed_keys.forget(getattr(instance, field.attname))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def add_account_email(sender, instance=None, update_fields=None, using=None, **kwargs):
+    if settings.ACCOUNT_EMAIL_BLOOM_FILTER and (update_fields is None or 'email' in update_fields):
+        email_filter.add(instance.email, using=using)
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance=None, **kwargs):
+    token_cache.delete(instance.key)
+
+
+@receiver(user_logged_out)
+def invalidate_logged_out_account(sender, request=None, user=None, **kwargs):
+    if user is not None:
+        invalidate_cached_user(user.pk)
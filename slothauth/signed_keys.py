@@ -0,0 +1,31 @@
+import time
+
+from django.core import signing
+
+from . import settings
+
+
+SALT = 'slothauth.signed_keys'
+
+
+def make_signed_key(user, kind, ttl=None):
+    """
+    Returns a key for user that carries its own user id, kind, expiry and the account's auth_key_version, signed with
+    SECRET_KEY. It is checked without touching the database, and stops working once it expires or the account's
+    auth_key_version moves on.
+    """
+    if ttl is None:
+        ttl = settings.ACCOUNT_AUTH_KEY_TTL.get(kind)
+    expires_at = int(time.time()) + ttl if ttl is not None else None
+    return signing.dumps([user.pk, kind, expires_at, user.auth_key_version], salt=SALT, compress=True)
+
+
+def load_signed_key(key, kind):
+    """ Returns the (user id, auth_key_version) of a valid, unexpired signed key of the given kind, or None """
+    try:
+        user_id, key_kind, expires_at, version = signing.loads(key, salt=SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if key_kind != kind or (expires_at is not None and expires_at <= time.time()):
+        return None
+    return user_id, version
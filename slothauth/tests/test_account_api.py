@@ -1,21 +1,47 @@
+import asyncio
 import json
+import threading
+import time
+from unittest import mock
 
 from django.contrib.auth import authenticate
-from django.contrib.auth import get_user_model
+from django.contrib.auth import BACKEND_SESSION_KEY, get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.signals import user_logged_out
+from django.contrib.sessions.backends.db import SessionStore
+from django.conf import settings as django_settings
 from django.contrib.sessions.models import Session
 from django.core import mail
-from django.test import TestCase
+from django.core.cache import cache, caches
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils.functional import SimpleLazyObject
 from django.core.urlresolvers import reverse
 
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 
 from .utils import obj_is
 from .api_utils import is_user_me
 
-from ..factories import AccountFactory
+from ..authentication import CachedTokenAuthentication
+from ..backends import PasswordlessAuthentication, session_auth_hash
+from ..exceptions import SlothAuthInvalidSetting
+from ..factories import AccountFactory, PasswordlessAccountFactory
+from ..mail import render_mail
+from ..middleware import AuthKeyMiddleware, ImpersonateMiddleware, OneTimeAuthenticationKeyMiddleware,\
+    PasswordlessUserMiddleware
+from ..models import AuthKey
+from ..utils import failed_keys
+from ..serializers import AccountSerializer, BasicAccountSerializer, FastAccountSerializer
+from ..views import AccountViewSet, BasicUserViewSet
 
 from .. import settings
 
@@ -79,6 +105,523 @@ class PasswordlessAuthTest(TestCase):
         self.assertEqual(users.count(), 1)
 
 
+class AsyncPasswordlessAuthTest(TransactionTestCase):
+
+    ACCOUNT_PASSWORD = 'test'
+
+    def setUp(self):
+        self.account_1 = Account(email='test1@taggler.com')
+        self.account_1.set_password(self.ACCOUNT_PASSWORD)
+        self.account_1.save()
+
+        self.backend = PasswordlessAuthentication()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def aauthenticate(self, **credentials):
+        return self.loop.run_until_complete(self.backend.aauthenticate(None, **credentials))
+
+    def test_email_password_auth(self):
+        self.assertEqual(self.aauthenticate(email=self.account_1.email, password=self.ACCOUNT_PASSWORD), self.account_1)
+
+    def test_email_password_fails_for_wrong_password(self):
+        self.assertIsNone(self.aauthenticate(email=self.account_1.email, password=self.ACCOUNT_PASSWORD*2))
+
+    def test_password_is_checked_off_the_event_loop(self):
+        threads = []
+        check_password = Account.check_password
+
+        def record_thread(user, password):
+            threads.append(threading.current_thread())
+            return check_password(user, password)
+
+        with mock.patch.object(Account, 'check_password', record_thread):
+            self.aauthenticate(email=self.account_1.email, password=self.ACCOUNT_PASSWORD)
+
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.current_thread())
+
+
+class AsyncMiddlewareTest(TransactionTestCase):
+
+    def setUp(self):
+        self.passwordless = Account(email='passwordless@taggler.com')
+        self.passwordless.save()
+
+        self.loop = asyncio.new_event_loop()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def make_request(self, data=None):
+        request = self.factory.get('/login', data)
+        request.session = SessionStore()
+        request.user = AnonymousUser()
+        return request
+
+    def call(self, middleware_class, request):
+        async def get_response(request):
+            return HttpResponse()
+
+        middleware = middleware_class(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        return self.loop.run_until_complete(middleware(request))
+
+    def test_requests_without_keys_stay_on_the_event_loop(self):
+        with mock.patch('slothauth.middleware.run_sync') as run_sync:
+            for middleware_class in (PasswordlessUserMiddleware, OneTimeAuthenticationKeyMiddleware, ImpersonateMiddleware):
+                self.call(middleware_class, self.make_request())
+
+        self.assertFalse(run_sync.called)
+
+    def test_passwordless_key_logs_in(self):
+        request = self.make_request({settings.PASSWORDLESS_GET_PARAM: self.passwordless.passwordless_key})
+
+        self.call(PasswordlessUserMiddleware, request)
+
+        self.assertEqual(request.user, self.passwordless)
+        self.assertEqual(int(request.session['_auth_user_id']), self.passwordless.pk)
+
+    def test_one_time_authentication_key_logs_in(self):
+        request = self.make_request({settings.ONE_TIME_AUTHENTICATION_KEY_GET_PARAM: self.passwordless.one_time_authentication_key})
+
+        self.call(OneTimeAuthenticationKeyMiddleware, request)
+
+        self.assertEqual(request.user, self.passwordless)
+
+    def test_impersonation_loads_session_and_user_off_the_event_loop(self):
+        admin = Account(email='admin@taggler.com', is_superuser=True)
+        admin.save()
+        request = self.make_request({'__impersonate': self.passwordless.pk})
+        request.COOKIES[django_settings.SESSION_COOKIE_NAME] = 'session'
+        request.user = SimpleLazyObject(lambda: admin if threading.current_thread() is not main_thread else None)
+
+        main_thread = threading.current_thread()
+        self.call(ImpersonateMiddleware, request)
+
+        self.assertEqual(request.user, self.passwordless)
+
+
+class AuthKeyMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.account = Account(email='test1@taggler.com')
+        self.account.set_password('test')
+        self.account.save()
+
+        self.factory = RequestFactory()
+        self.middleware = AuthKeyMiddleware(lambda request: HttpResponse())
+
+    def make_request(self, data=None, user=None):
+        request = self.factory.get('/login', data)
+        request.session = SessionStore()
+        request.user = user or AnonymousUser()
+        return request
+
+    def test_requests_without_keys_make_no_queries(self):
+        with self.assertNumQueries(0):
+            self.middleware(self.make_request())
+            self.middleware(self.make_request({'page': '2'}))
+
+    def test_passwordless_key_logs_in(self):
+        request = self.make_request({settings.PASSWORDLESS_GET_PARAM: self.account.passwordless_key})
+
+        self.middleware(request)
+
+        self.assertEqual(request.user, self.account)
+        self.assertEqual(request.session[BACKEND_SESSION_KEY], 'slothauth.backends.PasswordlessAuthentication')
+
+    def test_one_time_authentication_key_logs_in_once(self):
+        one_time_authentication_key = self.account.one_time_authentication_key
+
+        request = self.make_request({settings.ONE_TIME_AUTHENTICATION_KEY_GET_PARAM: one_time_authentication_key})
+        self.middleware(request)
+        self.assertEqual(request.user, self.account)
+
+        request = self.make_request({settings.ONE_TIME_AUTHENTICATION_KEY_GET_PARAM: one_time_authentication_key})
+        self.middleware(request)
+        self.assertFalse(request.user.is_authenticated)
+
+    @override_settings(AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend',
+                                                'slothauth.backends.PasswordlessAuthentication'])
+    def test_bad_key_is_one_query(self):
+        middleware = AuthKeyMiddleware(lambda request: HttpResponse())
+
+        with self.assertNumQueries(1):
+            middleware(self.make_request({settings.PASSWORDLESS_GET_PARAM: 'bogus'}))
+
+    def test_impersonation(self):
+        staff = AccountFactory(can_impersonate=True)
+
+        request = self.make_request({'__impersonate': self.account.pk}, user=staff)
+        self.middleware(request)
+        self.assertEqual(request.user, self.account)
+
+        session = request.session
+        request = self.make_request(user=staff)
+        request.session = session
+        self.middleware(request)
+        self.assertEqual(request.user, self.account)
+
+        request = self.make_request({'__unimpersonate': ''}, user=staff)
+        request.session = session
+        self.middleware(request)
+        self.assertEqual(request.user, staff)
+        self.assertNotIn('impersonate_id', session)
+
+
+class SignedKeyTest(TestCase):
+
+    def setUp(self):
+        self.account = PasswordlessAccountFactory()
+        self.backend = PasswordlessAuthentication()
+        self.settings_patch = mock.patch.object(settings, 'ACCOUNT_SIGNED_KEYS', True)
+        self.settings_patch.start()
+
+    def tearDown(self):
+        self.settings_patch.stop()
+
+    def test_passwordless_key_is_one_query(self):
+        passwordless_key = self.account.get_passwordless_key()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.authenticate(passwordless_key=passwordless_key, force=True), self.account)
+        self.assertEqual(self.backend.authenticate(passwordless_key=passwordless_key, force=True), self.account)
+
+    def test_bad_keys_make_no_queries(self):
+        passwordless_key = self.account.get_passwordless_key()
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.backend.authenticate(passwordless_key='bogus', force=True))
+            self.assertIsNone(self.backend.authenticate(passwordless_key=passwordless_key[:-1], force=True))
+            self.assertIsNone(self.backend.authenticate(passwordless_key=self.account.passwordless_key, force=True))
+            # A key of one kind can't be used as another
+            self.assertIsNone(self.backend.authenticate(one_time_authentication_key=passwordless_key))
+
+    def test_expired_key_makes_no_queries(self):
+        passwordless_key = self.account.get_passwordless_key()
+
+        with mock.patch('slothauth.signed_keys.time.time', return_value=time.time() + 60 * 60 * 24 * 365):
+            with self.assertNumQueries(0):
+                self.assertIsNone(self.backend.authenticate(passwordless_key=passwordless_key, force=True))
+
+    def test_one_time_authentication_key_works_once(self):
+        one_time_authentication_key = self.account.get_one_time_authentication_key()
+
+        self.assertEqual(self.backend.authenticate(one_time_authentication_key=one_time_authentication_key),
+                         self.account)
+        self.assertIsNone(self.backend.authenticate(one_time_authentication_key=one_time_authentication_key))
+
+    def test_revoke_signed_keys(self):
+        passwordless_key = self.account.get_passwordless_key()
+        self.account.revoke_signed_keys()
+
+        self.assertIsNone(self.backend.authenticate(passwordless_key=passwordless_key, force=True))
+        self.assertEqual(self.backend.authenticate(passwordless_key=self.account.get_passwordless_key(), force=True),
+                         self.account)
+
+
+class FailedKeyCacheTest(TestCase):
+
+    def setUp(self):
+        self.account = PasswordlessAccountFactory()
+        self.backend = PasswordlessAuthentication()
+        failed_keys.clear()
+        self.cache_patch = mock.patch.multiple(failed_keys, maxsize=100, hits=0, misses=0)
+        self.cache_patch.start()
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        failed_keys.clear()
+
+    def test_failed_key_is_looked_up_once(self):
+        with self.assertNumQueries(1):
+            for i in range(0, 3):
+                self.assertIsNone(self.backend.get_user_by_passwordless_key('bogus'))
+        self.assertEqual(failed_keys.stats['hits'], 2)
+        self.assertEqual(failed_keys.stats['misses'], 1)
+
+    def test_failures_are_per_kind(self):
+        self.backend.get_user_by_one_time_authentication_key(self.account.passwordless_key)
+        self.assertEqual(self.backend.get_user_by_passwordless_key(self.account.passwordless_key), self.account)
+
+    def test_used_one_time_authentication_key_is_remembered(self):
+        one_time_authentication_key = self.account.one_time_authentication_key
+        self.assertEqual(self.backend.get_user_by_one_time_authentication_key(one_time_authentication_key),
+                         self.account)
+        self.backend.get_user_by_one_time_authentication_key(one_time_authentication_key)
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.backend.get_user_by_one_time_authentication_key(one_time_authentication_key))
+
+    def test_generated_key_is_forgotten(self):
+        failed_keys.add('generated', 'passwordless')
+        with mock.patch('slothauth.utils.RandomField.generate_value', return_value='generated'):
+            account = Account.objects.create(email='generated@taggler.com')
+
+        self.assertEqual(account.passwordless_key, 'generated')
+        self.assertEqual(self.backend.get_user_by_passwordless_key('generated'), account)
+
+    def test_saved_key_is_forgotten(self):
+        self.backend.get_user_by_passwordless_key('chosen')
+        self.account.passwordless_key = 'chosen'
+        self.account.save()
+
+        self.assertEqual(self.backend.get_user_by_passwordless_key('chosen'), self.account)
+
+
+class ImpersonationCacheTest(TestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.settings_patch = mock.patch.object(settings, 'ACCOUNT_IMPERSONATE_CACHE', 'shared')
+        self.settings_patch.start()
+        self.account = AccountFactory(first_name='Target')
+        self.staff = AccountFactory(can_impersonate=True)
+        self.session = SessionStore()
+        self.session['impersonate_id'] = self.account.pk
+        self.middleware = ImpersonateMiddleware(lambda request: HttpResponse())
+
+    def tearDown(self):
+        self.settings_patch.stop()
+
+    def impersonate(self):
+        request = RequestFactory().get('/')
+        request.session = self.session
+        request.user = self.staff
+        self.middleware(request)
+        return request
+
+    def test_target_is_lazy(self):
+        with self.assertNumQueries(0):
+            request = self.impersonate()
+        with self.assertNumQueries(1):
+            self.assertEqual(request.user.first_name, 'Target')
+
+    def test_target_is_cached_until_saved(self):
+        self.assertEqual(self.impersonate().user.first_name, 'Target')
+        with self.assertNumQueries(0):
+            user = self.impersonate().user
+            self.assertEqual(user.pk, self.account.pk)
+            self.assertEqual(user.first_name, 'Target')
+
+        self.account.first_name = 'Renamed'
+        self.account.save()
+
+        self.assertEqual(self.impersonate().user.first_name, 'Renamed')
+
+    def test_cached_target_is_not_shared(self):
+        self.impersonate().user.first_name = 'Changed'
+
+        self.assertEqual(self.impersonate().user.first_name, 'Target')
+
+    def test_deleted_target_is_evicted(self):
+        self.impersonate().user.pk
+        self.account.delete()
+
+        self.assertRaises(Account.DoesNotExist, lambda: self.impersonate().user.pk)
+
+    def test_not_cached_by_default(self):
+        with mock.patch.object(settings, 'ACCOUNT_IMPERSONATE_CACHE', None):
+            self.impersonate().user.pk
+            with self.assertNumQueries(1):
+                self.impersonate().user.pk
+
+    def test_per_process_cache_is_refused(self):
+        with mock.patch.object(settings, 'ACCOUNT_IMPERSONATE_CACHE', 'default'):
+            self.assertRaises(SlothAuthInvalidSetting, lambda: self.impersonate().user.pk)
+
+
+class CachedGetUserTest(TestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.account = AccountFactory(first_name='Cached')
+        self.backend = PasswordlessAuthentication()
+        self.settings_patch = mock.patch.object(settings, 'ACCOUNT_USER_CACHE', 'shared')
+        self.settings_patch.start()
+
+    def tearDown(self):
+        self.settings_patch.stop()
+
+    def test_get_user_is_cached(self):
+        self.assertEqual(self.backend.get_user(self.account.pk), self.account)
+
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.account.pk)
+        self.assertEqual(user.first_name, 'Cached')
+        self.assertEqual(user.get_session_auth_hash(), self.account.get_session_auth_hash())
+
+    def test_save_invalidates(self):
+        self.backend.get_user(self.account.pk)
+        self.account.first_name = 'Changed'
+        self.account.save()
+
+        self.assertEqual(self.backend.get_user(self.account.pk).first_name, 'Changed')
+
+    def test_delete_invalidates(self):
+        self.backend.get_user(self.account.pk)
+        pk = self.account.pk
+        self.account.delete()
+
+        self.assertIsNone(self.backend.get_user(pk))
+
+    def test_entries_for_every_session_hash_are_invalidated(self):
+        for auth_hash in ('old', 'new'):
+            with session_auth_hash(auth_hash):
+                self.backend.get_user(self.account.pk)
+        self.account.save()
+
+        for auth_hash in ('old', 'new'):
+            with session_auth_hash(auth_hash), self.assertNumQueries(1):
+                self.backend.get_user(self.account.pk)
+
+    def test_password_change_misses_the_cache(self):
+        with session_auth_hash(self.account.get_session_auth_hash()):
+            self.backend.get_user(self.account.pk)
+        # Changed without a save signal reaching the cache
+        Account.objects.filter(pk=self.account.pk).update(password=make_password('changed'))
+        changed = Account.objects.get(pk=self.account.pk)
+
+        with session_auth_hash(changed.get_session_auth_hash()), self.assertNumQueries(1):
+            user = self.backend.get_user(self.account.pk)
+        self.assertTrue(user.check_password('changed'))
+
+    def test_per_process_cache_is_refused(self):
+        with mock.patch.object(settings, 'ACCOUNT_USER_CACHE', 'default'):
+            self.assertRaises(SlothAuthInvalidSetting, self.backend.get_user, self.account.pk)
+
+    def test_logout_invalidates(self):
+        self.backend.get_user(self.account.pk)
+        user_logged_out.send(sender=Account, request=None, user=self.account)
+
+        with self.assertNumQueries(1):
+            self.backend.get_user(self.account.pk)
+
+    @override_settings(MIDDLEWARE=[name.replace('django.contrib.auth.middleware.AuthenticationMiddleware',
+                                                'slothauth.middleware.AuthenticationMiddleware')
+                                   for name in django_settings.MIDDLEWARE])
+    def test_session_requests_skip_the_users_table(self):
+        client = Client()
+        client.force_login(self.account, backend='slothauth.backends.PasswordlessAuthentication')
+        client.get('/api/v1/accounts/me/')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/v1/accounts/me/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        account_table = Account._meta.db_table
+        self.assertFalse([query for query in queries.captured_queries if 'FROM "%s"' % account_table in query['sql']])
+
+
+class AccountSerializerQueryTest(TestCase):
+
+    def test_list_is_one_query(self):
+        AccountFactory.create_batch(5)
+
+        with self.assertNumQueries(1):
+            data = AccountSerializer(AccountViewSet.queryset.all(), many=True).data
+        self.assertEqual(len(data), 5)
+        self.assertTrue(all(account['auth_token'] for account in data))
+
+    def test_fast_serializer_matches_account_serializer(self):
+        accounts = [AccountFactory(first_name='Zoë', last_name='Ñúñez'), AccountFactory(first_name='', last_name=''),
+                    AccountFactory()]
+        # An account that hasn't asked for a lazy token yet
+        Token.objects.filter(user=accounts[-1]).delete()
+
+        with mock.patch.object(settings, 'ACCOUNT_LAZY_AUTH_TOKEN', True):
+            for account in AccountViewSet.queryset.filter(pk__in=[account.pk for account in accounts]):
+                expected = AccountSerializer(account).data
+                data = FastAccountSerializer(account).data
+                self.assertEqual(list(data.items()), list(expected.items()))
+                self.assertEqual(JSONRenderer().render(data), JSONRenderer().render(expected))
+
+    def test_me_does_not_query_the_token(self):
+        client = Client()
+        client.force_login(AccountFactory(), backend='slothauth.backends.PasswordlessAuthentication')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/v1/accounts/me/')
+        self.assertTrue(response.json()['auth_token'])
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('SELECT "%s"' % Token._meta.db_table)])
+
+    def test_basic_list_does_not_join_the_token(self):
+        AccountFactory.create_batch(2)
+
+        with CaptureQueriesContext(connection) as queries:
+            data = BasicAccountSerializer(BasicUserViewSet.queryset.all(), many=True).data
+        self.assertEqual(len(data), 2)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn(Token._meta.db_table, queries.captured_queries[0]['sql'])
+
+
+class CachedTokenAuthenticationTest(TestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.settings_patch = mock.patch.object(settings, 'ACCOUNT_TOKEN_CACHE', 'shared')
+        self.settings_patch.start()
+        self.account = AccountFactory(first_name='Token')
+        self.token = Token.objects.get(user=self.account)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.authentication_patch = mock.patch.object(AccountViewSet, 'authentication_classes',
+                                                      (CachedTokenAuthentication, ))
+        self.authentication_patch.start()
+
+    def tearDown(self):
+        self.authentication_patch.stop()
+        self.settings_patch.stop()
+
+    def me(self):
+        response = self.client.get('/api/v1/accounts/me/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_cached_token_makes_no_queries(self):
+        self.me()
+
+        with self.assertNumQueries(0):
+            response = self.me()
+        self.assertEqual(response.data['first_name'], 'Token')
+
+    def test_invalid_token_is_rejected(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token nope')
+        response = self.client.get('/api/v1/accounts/me/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_token_is_rejected(self):
+        self.me()
+        self.token.delete()
+
+        response = self.client.get('/api/v1/accounts/me/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_account_is_rejected(self):
+        self.me()
+        self.account.is_active = False
+        self.account.save()
+
+        response = self.client.get('/api/v1/accounts/me/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_saved_account_is_evicted(self):
+        self.me()
+        self.account.first_name = 'Changed'
+        self.account.save()
+
+        self.assertEqual(self.me().data['first_name'], 'Changed')
+
+    def test_per_process_cache_is_refused(self):
+        for alias in (None, 'default'):
+            with mock.patch.object(settings, 'ACCOUNT_TOKEN_CACHE', alias):
+                self.assertRaises(SlothAuthInvalidSetting, self.client.get, '/api/v1/accounts/me/')
+
+
 class OneTimeAuthenticationKeyAuthTest(TestCase):
 
     ACCOUNT_PASSWORD = 'test'
@@ -113,6 +656,24 @@ class OneTimeAuthenticationKeyAuthTest(TestCase):
         # Check that one time authentication key changed upon use
         self.assertNotEqual(users[0].one_time_authentication_key, one_time_authentication_key)
 
+    def test_one_time_authentication_key_is_consumed_atomically(self):
+        one_time_authentication_key = self.account_1.one_time_authentication_key
+
+        with self.assertNumQueries(2):
+            user = authenticate(one_time_authentication_key=one_time_authentication_key)
+        self.assertEqual(user, self.account_1)
+        self.assertEqual(Account.objects.get(pk=user.pk).one_time_authentication_key, user.one_time_authentication_key)
+        self.assertIsNone(authenticate(one_time_authentication_key=one_time_authentication_key))
+
+    def test_one_time_authentication_key_lost_race(self):
+        one_time_authentication_key = self.account_1.one_time_authentication_key
+        stale = Account.objects.get(pk=self.account_1.pk)
+
+        # Another request consumes the key between our lookup and our update
+        Account.objects.filter(pk=stale.pk).update(one_time_authentication_key='consumed')
+        with mock.patch.object(QuerySet, 'last', return_value=stale):
+            self.assertIsNone(authenticate(one_time_authentication_key=one_time_authentication_key))
+
 
 class SignupEmailTest(TestCase):
 
@@ -163,12 +724,67 @@ class ApiAuthTest(TestCase):
         account = Account.objects.get(email=self.email)
         self.assertTrue(account.is_passwordless)
 
+    def test_auth_signup_query_count(self):
+        # Email check, account and token INSERTs, session creation, last_login UPDATE and the session save, plus the
+        # savepoints around them, and without ACCOUNT_KEYS_UNIQUE a query per key checking it isn't taken. The
+        # account is neither looked up again nor saved a second time.
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('account-signup'), data={'email': self.email, 'password': self.password},
+                                        format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        statements = [query['sql'] for query in queries.captured_queries if 'SAVEPOINT' not in query['sql']]
+        key_checks = 0 if Account._meta.get_field('passwordless_key').unique else 3
+        self.assertEqual(len(statements), 7 + key_checks, msg='\n'.join(statements))
+        account_table = Account._meta.db_table
+        self.assertEqual(len([sql for sql in statements if sql.startswith('INSERT INTO "%s"' % account_table)]), 1)
+        self.assertEqual(len([sql for sql in statements if sql.startswith('UPDATE "%s"' % account_table)]), 1)
+        self.assertTrue(Account.objects.get(email=self.email).check_password(self.password))
+
+    def test_lazy_auth_token(self):
+        with mock.patch.object(settings, 'ACCOUNT_LAZY_AUTH_TOKEN', True):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse('account-signup'), data={'email': self.email}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIsNone(response.data['auth_token'])
+            self.assertFalse([query for query in queries.captured_queries
+                              if query['sql'].startswith('INSERT INTO "%s"' % Token._meta.db_table)])
+
+            response = self.client.post(reverse('account-auth-token'), format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            auth_token = response.data['auth_token']
+            self.assertEqual(self.client.get(reverse('account-auth-token')).data['auth_token'], auth_token)
+            self.assertEqual(self.client.get(reverse('account-me')).data['auth_token'], auth_token)
+        self.assertEqual(Token.objects.get(user__email=self.email).key, auth_token)
+
     def test_auth_signup_email_taken(self):
         self.test_auth_signup_passwordless()
 
         response = self.client.post(reverse('account-signup'), data={'email': self.email}, format='json')
         self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED, msg=str(response.status_code) + ': ' + str(response.content))
 
+    def test_auth_signup_email_taken_optimistic(self):
+        self.test_auth_signup_passwordless()
+        self.client.logout()
+
+        with mock.patch.object(settings, 'ACCOUNT_FORM_OPTIMISTIC_EMAIL', True):
+            response = self.client.post(reverse('account-signup'), data={'email': self.email.upper()}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertIn('email', response.data['error'])
+        self.assertEqual(Account.objects.filter(email=self.email).count(), 1)
+
+    def test_patch_me_email_taken_optimistic(self):
+        AccountFactory(email='taken@taggler.com')
+        self.test_auth_signup_passwordless()
+
+        with mock.patch.object(settings, 'ACCOUNT_FORM_OPTIMISTIC_EMAIL', True):
+            response = self.client.patch(reverse('account-me'), data={'email': 'taken@taggler.com'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+            self.assertIn('email', response.data['error'])
+
+            response = self.client.patch(reverse('account-me'), data={'email': 'free@taggler.com'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(Account.objects.filter(email='free@taggler.com').exists())
+
     def test_auth_signup_with_password(self):
         response = self.client.post(reverse('account-signup'), data={'email': self.email, 'password': self.password}, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK, msg=str(response.status_code) + ': ' + str(response.content))
@@ -275,6 +891,68 @@ class ApiAuthTest(TestCase):
 
         self.assertEqual(account.email, NEW_EMAIL)
 
+    def test_account_mutations_write_only_changed_columns(self):
+        self.test_auth_signup_with_password()
+        account = Account.objects.get(email=self.email)
+        password_reset_key = account.password_reset_key
+        account_table = Account._meta.db_table
+
+        def account_updates(method, data):
+            with CaptureQueriesContext(connection) as queries:
+                response = method(data)
+            self.assertLess(response.status_code, 300, msg=response.content)
+            return [query['sql'] for query in queries.captured_queries
+                    if query['sql'].startswith('UPDATE "%s"' % account_table)]
+
+        updates = account_updates(lambda data: self.client.post('/api/v1/accounts/change_settings/', data=data,
+                                                                format='json'), {'first_name': 'Partial'})
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"email"', updates[0])
+        self.assertNotIn('passwordless_key', updates[0])
+
+        updates = account_updates(lambda data: self.client.patch(reverse('account-me'), data=data, format='json'),
+                                  {'last_name': 'Patched'})
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('first_name', updates[0])
+
+        updates = account_updates(lambda data: self.client.post('/api/v1/accounts/change_password/', data=data,
+                                                                format='json'),
+                                  {'password_reset_key': password_reset_key, 'password': 'new password',
+                                   'password_repeat': 'new password'})
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('first_name', updates[0])
+
+        account = Account.objects.get(pk=account.pk)
+        self.assertEqual((account.first_name, account.last_name), ('Partial', 'Patched'))
+        self.assertTrue(account.check_password('new password'))
+        self.assertEqual(len(account.password_reset_key), 32)
+        self.assertNotEqual(account.password_reset_key, password_reset_key)
+
+    def test_change_password_with_auth_key(self):
+        self.test_auth_signup_with_password()
+        account = Account.objects.get(email=self.email)
+        other = AccountFactory()
+
+        def change_password(password_reset_key):
+            return self.client.post('/api/v1/accounts/change_password/',
+                                    data={'password_reset_key': password_reset_key, 'password': 'new password',
+                                          'password_repeat': 'new password'}, format='json')
+
+        with mock.patch.object(settings, 'ACCOUNT_AUTH_KEYS', True):
+            with mock.patch('slothauth.forms.render_mail', wraps=render_mail) as rendered:
+                account.send_reset_email()
+            password_reset_key = rendered.call_args[0][3]['password_reset_key']
+            self.assertTrue(AuthKey.objects.filter(key=password_reset_key, user=account).exists())
+
+            # Someone else's key is rejected and stays usable by its owner
+            other_key = other.get_password_reset_key()
+            self.assertEqual(change_password(other_key).status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertTrue(AuthKey.objects.filter(key=other_key).exists())
+
+            self.assertEqual(change_password(password_reset_key).status_code, status.HTTP_204_NO_CONTENT)
+            self.assertTrue(Account.objects.get(pk=account.pk).check_password('new password'))
+            self.assertFalse(AuthKey.objects.filter(key=password_reset_key).exists())
+
     def test_change_password(self):
 
         NEW_PASSWORD = self.password + '1'
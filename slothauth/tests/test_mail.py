@@ -0,0 +1,309 @@
+import smtplib
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.template.loader import render_to_string
+from django.test import TestCase, override_settings
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from ..factories import PasswordlessAccountFactory
+from ..mail import close_connection_pools, get_email_template, make_mail, render_mail, send_mail, send_many,\
+    shutdown_dispatch_queue
+from ..models import EmailOutbox
+
+from .. import settings
+
+
+MAIL_LATENCY = 0.2
+
+
+class SlowEmailBackend(locmem.EmailBackend):
+    """ locmem backend that takes MAIL_LATENCY seconds per message, like a slow SMTP server """
+
+    def send_messages(self, messages):
+        time.sleep(MAIL_LATENCY * len(messages))
+        return super(SlowEmailBackend, self).send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='slothauth.tests.test_mail.SlowEmailBackend')
+class DispatchQueueTest(TestCase):
+
+    REQUESTS = 10
+
+    def setUp(self):
+        self.client = APIClient()
+        self.account = PasswordlessAccountFactory()
+
+    def tearDown(self):
+        shutdown_dispatch_queue()
+
+    def request_latencies(self):
+        latencies = []
+        for i in range(0, self.REQUESTS):
+            start = time.time()
+            response = self.client.post(reverse('account-login'), data={'email': self.account.email}, format='json')
+            latencies.append(time.time() - start)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted(latencies)
+
+    def test_request_waits_for_mail_without_queue(self):
+        latencies = self.request_latencies()
+
+        self.assertGreaterEqual(latencies[0], MAIL_LATENCY)
+        self.assertEqual(len(mail.outbox), self.REQUESTS)
+
+    def test_request_does_not_wait_for_mail_with_queue(self):
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_QUEUE', True):
+            latencies = self.request_latencies()
+
+        # p99 of the requests stays below the latency of a single email
+        self.assertLess(latencies[int(len(latencies) * 0.99)], MAIL_LATENCY)
+
+        shutdown_dispatch_queue()
+        self.assertEqual(len(mail.outbox), self.REQUESTS)
+
+
+class EmailOutboxTest(TestCase):
+
+    def setUp(self):
+        self.account = PasswordlessAccountFactory()
+
+    def test_emails_are_written_to_outbox(self):
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_OUTBOX', True):
+            self.account.send_passwordless_login_email()
+            self.account.send_reset_email()
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(EmailOutbox.objects.pending().count(), 2)
+
+        call_command('slothauth_send_outbox', batch_size=1, stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, [self.account.email])
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+        self.assertEqual(EmailOutbox.objects.pending().count(), 0)
+
+    def test_failed_emails_are_retried(self):
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_OUTBOX', True):
+            self.account.send_passwordless_login_email()
+
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', side_effect=Exception('connection refused')):
+            self.assertEqual(EmailOutbox.objects.send_pending(), 1)
+
+        email = EmailOutbox.objects.get()
+        self.assertIsNone(email.sent_at)
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.last_error, 'connection refused')
+
+        self.assertEqual(EmailOutbox.objects.send_pending(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(EmailOutbox.objects.send_pending(), 0)
+
+    def test_connection_failures_are_recorded(self):
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_OUTBOX', True):
+            self.account.send_passwordless_login_email()
+
+        with mock.patch.object(locmem.EmailBackend, 'open', side_effect=ConnectionRefusedError('connection refused')):
+            self.assertEqual(EmailOutbox.objects.send_pending(), 0)
+
+        email = EmailOutbox.objects.get()
+        self.assertIsNone(email.sent_at)
+        self.assertEqual(email.attempts, 0)
+        self.assertEqual(email.last_error, 'connection refused')
+
+        self.assertEqual(EmailOutbox.objects.send_pending(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_loop_keeps_running_after_errors(self):
+        stderr = StringIO()
+        with mock.patch.object(EmailOutbox.objects, 'send_pending', side_effect=[Exception('database is locked'), 1, 0])\
+                as send_pending,\
+                mock.patch('slothauth.management.commands.slothauth_send_outbox.time.sleep',
+                           side_effect=[None, KeyboardInterrupt]):
+            self.assertRaises(KeyboardInterrupt, call_command, 'slothauth_send_outbox', loop=True, stdout=StringIO(),
+                              stderr=stderr)
+
+        self.assertEqual(send_pending.call_count, 3)
+        self.assertIn('database is locked', stderr.getvalue())
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections.append(self.connection)
+        # Stands in for the TCP, greeting and TLS round trips of a real mail server
+        time.sleep(self.server.handshake_latency)
+        self.wfile.write(b'220 localhost ESMTP\r\n')
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    self.server.messages += 1
+                    if self.server.messages == self.server.drop_after:
+                        # Accepts the message but goes away before the client hears about it
+                        return
+                    self.wfile.write(b'250 OK\r\n')
+                continue
+            command = line[:4].upper()
+            if command == b'DATA':
+                in_data = True
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+class SMTPStandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake_latency=0.02):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPStandInHandler)
+        self.handshake_latency = handshake_latency
+        self.connections = []
+        self.messages = 0
+        self.drop_after = None
+
+    def drop_connections(self):
+        for connection in self.connections:
+            connection.shutdown(socket.SHUT_RDWR)
+
+
+class ConnectionPoolTest(TestCase):
+
+    MESSAGES = 10
+
+    def setUp(self):
+        self.server = SMTPStandInServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.settings_override = override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                                   EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server.server_address[1])
+        self.settings_override.enable()
+
+    def tearDown(self):
+        close_connection_pools()
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send(self):
+        start = time.time()
+        for i in range(0, self.MESSAGES):
+            send_mail('Subject', 'Body', '<p>Body</p>', 'from@example.com', 'to%d@example.com' % i)
+        return time.time() - start
+
+    def test_pool_saves_handshakes(self):
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_CONNECTION_POOL', False):
+            unpooled = self.send()
+        self.assertEqual(len(self.server.connections), self.MESSAGES)
+
+        del self.server.connections[:]
+        pooled = self.send()
+
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.server.messages, self.MESSAGES * 2)
+        self.assertLess(pooled, unpooled, msg='pooled %.3fs, unpooled %.3fs' % (pooled, unpooled))
+
+    def test_send_many_uses_one_connection(self):
+        messages = [make_mail('Subject', 'Body', None, 'from@example.com', 'to%d@example.com' % i)
+                    for i in range(0, self.MESSAGES)]
+
+        send_many(messages)
+
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.server.messages, self.MESSAGES)
+
+    def test_pool_reconnects_after_server_drops_connection(self):
+        send_mail('Subject', 'Body', None, 'from@example.com', 'to@example.com')
+        self.server.drop_connections()
+
+        send_mail('Subject', 'Body', None, 'from@example.com', 'to@example.com')
+
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(self.server.messages, 2)
+
+    def test_pool_does_not_resend_after_drop_partway_through(self):
+        send_mail('Subject', 'Body', None, 'from@example.com', 'to@example.com')
+        self.server.drop_after = 3
+        messages = [make_mail('Subject', 'Body', None, 'from@example.com', 'to%d@example.com' % i)
+                    for i in range(0, self.MESSAGES)]
+
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            send_many(messages)
+
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.server.messages, 3)
+
+
+class EmailTemplateTest(TestCase):
+
+    TEXT_TEMPLATE = 'slothauth/passwordless_login_email.txt'
+    HTML_TEMPLATE = 'slothauth/passwordless_login_email.html'
+
+    def setUp(self):
+        self.context = {'domain': 'example.com', 'protocol': 'https', 'passwordless_key': 'abc'}
+
+    def test_renders_like_render_to_string(self):
+        message_plain, message_html = get_email_template(self.TEXT_TEMPLATE, self.HTML_TEMPLATE).render(self.context)
+
+        self.assertEqual(message_plain, render_to_string(self.TEXT_TEMPLATE, self.context))
+        self.assertEqual(message_html, render_to_string(self.HTML_TEMPLATE, self.context))
+
+    def test_templates_are_compiled_once(self):
+        get_email_template(self.TEXT_TEMPLATE, self.HTML_TEMPLATE)
+
+        with mock.patch('slothauth.mail.get_template') as get_template:
+            for i in range(0, 5):
+                render_mail('Subject', self.TEXT_TEMPLATE, self.HTML_TEMPLATE, self.context, 'from@example.com',
+                            'to@example.com')
+
+        self.assertFalse(get_template.called)
+
+    def test_css_is_read_once(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.css') as css_file:
+            css_file.write('p { color: red; }')
+            css_file.flush()
+
+            email_template = get_email_template(self.TEXT_TEMPLATE, self.HTML_TEMPLATE, css_file.name)
+            with mock.patch('slothauth.mail.make_css_inliner') as make_css_inliner:
+                message_plain, message_html = email_template.render(self.context)
+                get_email_template(self.TEXT_TEMPLATE, self.HTML_TEMPLATE, css_file.name).render(self.context)
+
+        self.assertFalse(make_css_inliner.called)
+        self.assertRegex(message_html, 'color: ?red')
+        self.assertIn('https://example.com/?key=abc', message_html)
+
+    def test_premailer_keeps_templated_links(self):
+        try:
+            import premailer  # noqa: F401
+        except ImportError:
+            self.skipTest('premailer is not installed')
+        with tempfile.NamedTemporaryFile('w', suffix='.css') as css_file:
+            css_file.write('a { color: red; }')
+            css_file.flush()
+
+            for context in (self.context, dict(self.context, passwordless_key='xyz')):
+                message_plain, message_html = get_email_template(self.TEXT_TEMPLATE, self.HTML_TEMPLATE,
+                                                                 css_file.name).render(context)
+                self.assertIn('href="https://example.com/?key=%s"' % context['passwordless_key'], message_html)
+                self.assertIn('style="color:red"', message_html)
+                self.assertNotIn('<style', message_html)
@@ -1,9 +1,30 @@
+import os
+import tempfile
+from io import StringIO
+from unittest import mock, skipIf, skipUnless
+
+from django.contrib.auth import authenticate, get_user_model
 from django.core import mail
-from django.test import TestCase
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ..bloom import email_filter
+from ..exceptions import SlothAuthInvalidSetting
+from ..forms import AccountForm
+from ..mail import passwordless_login_coalescer
+from ..models import AuthKey
+from ..utils import RandomField
 
+from .. import settings
 
 from ..factories import AccountFactory, PasswordlessAccountFactory
 
+Account = get_user_model()
+
 
 class AccountModelTest(TestCase):
 
@@ -23,3 +44,394 @@ class AccountModelTest(TestCase):
         passwordless_account.send_passwordless_login_email()
 
         self.assertEqual(len(mail.outbox), 1)
+
+
+KEYS_UNIQUE = Account._meta.get_field('passwordless_key').unique
+
+
+class RandomFieldTest(TestCase):
+
+    @skipUnless(KEYS_UNIQUE, 'Keys are only generated without queries with ACCOUNT_KEYS_UNIQUE')
+    def test_keys_generated_without_queries(self):
+        account = Account(email='random@taggler.com')
+
+        with CaptureQueriesContext(connection) as queries:
+            account.save()
+
+        selects = [query for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(selects, [])
+        self.assertEqual(len(account.passwordless_key), 32)
+        self.assertEqual(len(account.one_time_authentication_key), 32)
+        self.assertEqual(len(account.password_reset_key), 32)
+
+    @skipIf(KEYS_UNIQUE, 'Unique keys are checked by the database instead')
+    def test_keys_checked_before_save(self):
+        account = Account(email='random@taggler.com')
+
+        with CaptureQueriesContext(connection) as queries:
+            account.save()
+
+        selects = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 3)
+        self.assertIn('passwordless_key', selects[0])
+
+    def test_key_collision_is_retried(self):
+        existing = AccountFactory()
+        values = iter([existing.passwordless_key, 'b' * 32, 'c' * 32, 'd' * 32])
+
+        with mock.patch.object(RandomField, 'generate_value', lambda field: next(values)):
+            account = Account(email='collision@taggler.com')
+            account.save()
+
+        self.assertNotEqual(account.passwordless_key, existing.passwordless_key)
+        self.assertEqual(Account.objects.filter(passwordless_key=existing.passwordless_key).count(), 1)
+
+    def test_keys_not_written_are_not_generated(self):
+        account = AccountFactory()
+        account.one_time_authentication_key = ''
+        account.first_name = 'Partial'
+
+        with CaptureQueriesContext(connection) as queries:
+            account.save(update_fields=['first_name'])
+
+        self.assertEqual(account.one_time_authentication_key, '')
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertNotIn('one_time_authentication_key', queries.captured_queries[0]['sql'])
+
+    def test_update_writes_changed_fields(self):
+        account = AccountFactory(first_name='Same')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(account.update(first_name='Same', last_name='Changed'), ['last_name'])
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertNotIn('first_name', queries.captured_queries[0]['sql'])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(account.update(last_name='Changed'), [])
+        self.assertEqual(Account.objects.get(pk=account.pk).last_name, 'Changed')
+
+
+@skipUnless(KEYS_UNIQUE, 'Only unique keys are saved without checking the table first')
+class UniqueKeyAutocommitTest(TransactionTestCase):
+
+    def test_save_outside_a_transaction_has_no_savepoint(self):
+        existing = AccountFactory()
+        values = iter([existing.passwordless_key, 'b' * 32, 'c' * 32, 'd' * 32])
+
+        with mock.patch.object(RandomField, 'generate_value', lambda field: next(values)),\
+                CaptureQueriesContext(connection) as queries:
+            account = Account(email='autocommit@taggler.com')
+            account.save()
+
+        self.assertNotEqual(account.passwordless_key, existing.passwordless_key)
+        self.assertFalse([query for query in queries.captured_queries if 'SAVEPOINT' in query['sql']])
+
+
+class AuthKeyTest(TestCase):
+
+    def setUp(self):
+        self.account = PasswordlessAccountFactory()
+
+    def test_issue_uses_kind_ttl(self):
+        auth_key = AuthKey.objects.issue(self.account, AuthKey.ONE_TIME_AUTHENTICATION)
+
+        self.assertEqual(len(auth_key.key), 32)
+        ttl = settings.ACCOUNT_AUTH_KEY_TTL[AuthKey.ONE_TIME_AUTHENTICATION]
+        self.assertAlmostEqual((auth_key.expires_at - auth_key.created).total_seconds(), ttl, delta=1)
+
+    def test_get_user_is_single_query(self):
+        auth_key = AuthKey.objects.issue(self.account, AuthKey.PASSWORDLESS)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(AuthKey.objects.get_user(auth_key.key, AuthKey.PASSWORDLESS), self.account)
+        self.assertIsNone(AuthKey.objects.get_user(auth_key.key, AuthKey.ONE_TIME_AUTHENTICATION))
+
+    def test_expired_keys_are_not_resolved(self):
+        auth_key = AuthKey.objects.issue(self.account, AuthKey.PASSWORDLESS, ttl=-1)
+
+        self.assertIsNone(AuthKey.objects.get_user(auth_key.key, AuthKey.PASSWORDLESS))
+
+    def test_consume_only_once(self):
+        auth_key = AuthKey.objects.issue(self.account, AuthKey.ONE_TIME_AUTHENTICATION)
+
+        self.assertEqual(AuthKey.objects.consume(auth_key.key, AuthKey.ONE_TIME_AUTHENTICATION), self.account)
+        self.assertIsNone(AuthKey.objects.consume(auth_key.key, AuthKey.ONE_TIME_AUTHENTICATION))
+
+    def test_consume_for_user(self):
+        auth_key = AuthKey.objects.issue(self.account, AuthKey.PASSWORD_RESET)
+        other = PasswordlessAccountFactory()
+
+        self.assertIsNone(AuthKey.objects.consume(auth_key.key, AuthKey.PASSWORD_RESET, user=other))
+        self.assertEqual(AuthKey.objects.consume(auth_key.key, AuthKey.PASSWORD_RESET, user=self.account),
+                         self.account)
+
+    def test_backend_resolves_auth_keys(self):
+        with mock.patch.object(settings, 'ACCOUNT_AUTH_KEYS', True):
+            self.assertIsNone(authenticate(passwordless_key=self.account.passwordless_key))
+            self.assertEqual(authenticate(passwordless_key=self.account.get_passwordless_key()), self.account)
+
+    def test_purge_expired_command(self):
+        AuthKey.objects.issue(self.account, AuthKey.PASSWORDLESS)
+        for i in range(0, 5):
+            AuthKey.objects.issue(self.account, AuthKey.ONE_TIME_AUTHENTICATION, ttl=-1)
+        AuthKey.objects.create(user=self.account, kind=AuthKey.PASSWORD_RESET, expires_at=None)
+
+        call_command('slothauth_purge_auth_keys', chunk_size=2, stdout=StringIO())
+
+        self.assertEqual(AuthKey.objects.count(), 2)
+        self.assertFalse(AuthKey.objects.filter(expires_at__lte=timezone.now()).exists())
+
+
+class PasswordlessLoginCoalescingTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.account = PasswordlessAccountFactory()
+
+    def test_repeated_emails_are_coalesced(self):
+        hits, misses = passwordless_login_coalescer.hits, passwordless_login_coalescer.misses
+
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_COALESCE_WINDOW', 60):
+            for i in range(0, 3):
+                self.account.send_passwordless_login_email()
+            PasswordlessAccountFactory().send_passwordless_login_email()
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(passwordless_login_coalescer.hits - hits, 2)
+        self.assertEqual(passwordless_login_coalescer.misses - misses, 2)
+
+    def test_failed_send_is_not_coalesced(self):
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_COALESCE_WINDOW', 60):
+            with mock.patch('slothauth.models.send_many', side_effect=Exception('connection refused')):
+                self.assertRaises(Exception, self.account.send_passwordless_login_email)
+            self.account.send_passwordless_login_email()
+
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_coalescing_off_by_default(self):
+        self.account.send_passwordless_login_email()
+        self.account.send_passwordless_login_email()
+
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class PasswordlessLoginCampaignTest(TestCase):
+
+    def setUp(self):
+        self.accounts = [PasswordlessAccountFactory() for i in range(0, 7)]
+        account = AccountFactory()
+        account.set_password('password')
+        account.save()
+        PasswordlessAccountFactory(is_active=False)
+
+    def test_sends_to_active_passwordless_accounts_in_chunks(self):
+        checkpoints = []
+
+        # One query per chunk of accounts and one for the empty chunk that ends the run
+        with self.assertNumQueries(4):
+            sent = Account.objects.filter(is_active=True).send_passwordless_login_emails(
+                chunk_size=3, workers=2, checkpoint=lambda last_pk, sent: checkpoints.append((last_pk, sent)))
+
+        self.assertEqual(sent, 7)
+        self.assertEqual(sorted(to for msg in mail.outbox for to in msg.to),
+                         sorted(account.email for account in self.accounts))
+        self.assertEqual(checkpoints, [(self.accounts[2].pk, 3), (self.accounts[5].pk, 6), (self.accounts[6].pk, 7)])
+
+    def test_command_resumes_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint_file = os.path.join(directory, 'checkpoint')
+            with open(checkpoint_file, 'w') as f:
+                f.write(str(self.accounts[3].pk))
+
+            call_command('slothauth_send_passwordless_login_emails', chunk_size=2, checkpoint_file=checkpoint_file,
+                         stdout=StringIO())
+
+            with open(checkpoint_file) as f:
+                self.assertEqual(int(f.read()), self.accounts[6].pk)
+
+        self.assertEqual(sorted(to for msg in mail.outbox for to in msg.to),
+                         sorted(account.email for account in self.accounts[4:]))
+
+
+class EmailFilterTest(TransactionTestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.account = AccountFactory(email='known@taggler.com')
+        self.filter_patch = mock.patch.multiple(email_filter, bloom=None, generation=None, refreshed_at=0,
+                                                thread=None, hits=0, misses=0)
+        self.filter_patch.start()
+        self.settings_patch = mock.patch.multiple(settings, ACCOUNT_EMAIL_BLOOM_FILTER=True,
+                                                  ACCOUNT_EMAIL_BLOOM_FILTER_CACHE='shared')
+        self.settings_patch.start()
+
+    def tearDown(self):
+        if email_filter.thread is not None:
+            email_filter.thread.join()
+        self.settings_patch.stop()
+        self.filter_patch.stop()
+
+    def test_unknown_emails_skip_the_database(self):
+        email_filter.load()
+
+        with self.assertNumQueries(0):
+            self.assertTrue(email_filter.might_exist(' Known@Taggler.com'))
+            self.assertFalse(email_filter.might_exist('unknown@taggler.com'))
+            self.assertTrue(AccountForm(data={'email': 'unknown@taggler.com'}).is_valid())
+        self.assertFalse(AccountForm(data={'email': 'KNOWN@taggler.com'}).is_valid())
+        self.assertLess(email_filter.stats['false_positive_rate'], 0.01)
+
+    def test_filter_is_loaded_in_the_background(self):
+        # The table scan doesn't run on the request's thread, which uses the database meanwhile
+        with self.assertNumQueries(0):
+            self.assertTrue(email_filter.might_exist('unknown@taggler.com'))
+        email_filter.thread.join()
+
+        self.assertFalse(email_filter.might_exist('unknown@taggler.com'))
+        self.assertEqual(email_filter.get_snapshot()[2], 1)
+
+    def test_one_process_rebuilds_at_a_time(self):
+        caches['shared'].add(email_filter.REBUILD_LOCK_KEY, True)
+
+        with self.assertNumQueries(0):
+            email_filter.load()
+        self.assertIsNone(email_filter.bloom)
+
+    def test_saved_accounts_are_added(self):
+        email_filter.load()
+        AccountFactory(email='new@taggler.com')
+
+        with self.assertNumQueries(0):
+            self.assertTrue(email_filter.might_exist('new@taggler.com'))
+
+    def test_uncommitted_accounts_are_not_added(self):
+        email_filter.load()
+        with transaction.atomic():
+            AccountFactory(email='new@taggler.com')
+            self.assertEqual(email_filter.get_generation(), email_filter.generation)
+            self.assertFalse(email_filter.might_exist('new@taggler.com'))
+        self.assertTrue(email_filter.might_exist('new@taggler.com'))
+
+    def test_saves_in_other_processes_make_the_filter_stale(self):
+        email_filter.load()
+        caches['shared'].set(email_filter.GENERATION_KEY, email_filter.generation + 1)
+
+        self.assertTrue(email_filter.might_exist('unknown@taggler.com'))
+
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER_REFRESH', 0):
+            email_filter.might_exist('unknown@taggler.com')
+        email_filter.thread.join()
+        self.assertFalse(email_filter.might_exist('unknown@taggler.com'))
+
+    def test_bulk_writes_make_the_filter_stale(self):
+        email_filter.load()
+        Account.objects.bulk_create([Account(email='bulk@taggler.com', passwordless_key='bulk1',
+                                             one_time_authentication_key='bulk2', password_reset_key='bulk3')])
+        self.assertTrue(email_filter.might_exist('bulk@taggler.com'))
+
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER_REFRESH', 0):
+            email_filter.load()
+        Account.objects.filter(email='bulk@taggler.com').update(email='updated@taggler.com')
+        self.assertTrue(email_filter.might_exist('updated@taggler.com'))
+
+    def test_stale_filter_miss_is_a_form_error(self):
+        email_filter.load()
+        # Written behind the filter's back, e.g. with raw SQL
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER', False):
+            AccountFactory(email='hidden@taggler.com')
+        self.assertFalse(email_filter.might_exist('hidden@taggler.com'))
+
+        form = AccountForm(data={'email': 'hidden@taggler.com'})
+        self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save())
+        self.assertEqual(form.errors['email'], [AccountForm.email_taken_message])
+
+    def test_per_process_cache_is_refused(self):
+        with mock.patch.object(settings, 'ACCOUNT_EMAIL_BLOOM_FILTER_CACHE', 'default'):
+            self.assertRaises(SlothAuthInvalidSetting, email_filter.might_exist, 'known@taggler.com')
+
+    def test_snapshot_is_stored_in_pieces(self):
+        # The default 1M emails at 1% is over memcached's 1 MB item limit
+        generation, bits, count = email_filter.rebuild()
+        self.assertGreater(len(bits), 1024 * 1024)
+        self.assertEqual(len(caches['shared'].get(email_filter.SNAPSHOT_KEY)[2]), 3)
+        self.assertEqual(email_filter.get_snapshot(), (generation, bits, count))
+
+    def test_replaced_snapshots_are_deleted(self):
+        email_filter.rebuild()
+        chunk_keys = caches['shared'].get(email_filter.SNAPSHOT_KEY)[2]
+
+        email_filter.rebuild()
+        self.assertEqual(caches['shared'].get_many(chunk_keys), {})
+        self.assertIsNotNone(email_filter.get_snapshot())
+
+    def test_rebuild_command(self):
+        out = StringIO()
+        call_command('slothauth_rebuild_email_filter', stdout=out)
+        self.assertIn('Added 1 emails', out.getvalue())
+
+        # Processes load the stored snapshot instead of scanning the table
+        with self.assertNumQueries(0):
+            email_filter.load()
+        self.assertFalse(email_filter.might_exist('unknown@taggler.com'))
+
+
+class CiEmailFieldTest(TestCase):
+
+    def test_iexact_matches_any_case(self):
+        account = AccountFactory(email='MixedCase@Taggler.com')
+
+        self.assertEqual(Account.objects.get(email__iexact='mixedcase@TAGGLER.com'), account)
+        self.assertEqual(authenticate(email='MIXEDCASE@taggler.com', password='nope'), None)
+
+    def test_iexact_uses_the_email_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+        sql, params = Account.objects.filter(email__iexact='Someone@Taggler.com').query.sql_with_params()
+        self.assertIn('= %s', sql)
+        self.assertEqual(params, ('someone@taggler.com', ))
+
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('USING INDEX', plan.replace('COVERING ', ''))
+
+    def test_iexact_is_not_uppercased_on_postgresql(self):
+        try:
+            from django.db.backends.postgresql.operations import DatabaseOperations
+        except ImportError:
+            self.skipTest('psycopg2 is not installed')
+        # Compiled with postgresql's operations, whose iexact cast is UPPER(%s::text)
+        default = connections['default']
+        with mock.patch.object(default, 'ops', DatabaseOperations(default)),\
+                mock.patch.object(default, 'vendor', 'postgresql'):
+            sql, params = Account.objects.filter(email__iexact='Someone@Taggler.com').query.sql_with_params()
+
+        self.assertNotIn('UPPER(', sql)
+        self.assertIn('"email" = %s', sql)
+        self.assertEqual(params, ('someone@taggler.com', ))
+
+
+class OptimisticAccountFormTest(TestCase):
+
+    def setUp(self):
+        self.account = AccountFactory(email='taken@taggler.com')
+        self.settings_patch = mock.patch.object(settings, 'ACCOUNT_FORM_OPTIMISTIC_EMAIL', True)
+        self.settings_patch.start()
+
+    def tearDown(self):
+        self.settings_patch.stop()
+
+    def test_email_is_not_checked_before_saving(self):
+        form = AccountForm(data={'email': 'new@taggler.com'})
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+        self.assertEqual(form.save().email, 'new@taggler.com')
+
+    def test_taken_email_is_a_form_error(self):
+        form = AccountForm(data={'email': 'Taken@taggler.com'})
+        self.assertTrue(form.is_valid())
+
+        self.assertIsNone(form.save())
+        self.assertEqual(form.errors['email'], [AccountForm.email_taken_message])
+        self.assertEqual(Account.objects.count(), 1)
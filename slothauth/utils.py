@@ -1,14 +1,24 @@
+from collections import OrderedDict
 from functools import wraps
 import logging
 import random
 import string
+import threading
+import time
 
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.db import connections
 from django.db import models
 from django.db.models import EmailField
+from django.db.models.lookups import BuiltinLookup, Exact
 from django.db.models.signals import pre_migrate
 from django.dispatch import receiver
 
+from .exceptions import SlothAuthInvalidSetting
+
+from . import settings
+
 
 # Credit: http://stackoverflow.com/questions/15624817/have-loaddata-ignore-or-disable-post-save-signals
 def disable_for_loaddata(signal_handler):
@@ -48,7 +58,114 @@ class InstanceDoesNotRequireFieldsMixin(object):
         return super(InstanceDoesNotRequireFieldsMixin, self).clean()
 
 
+class LRUCache(object):
+    """
+    Thread safe mapping holding at most maxsize keys, evicting the least recently used one. Keys older than ttl
+    seconds, if given, are treated as missing. Counts hits and misses.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class FailedKeyCache(LRUCache):
+    """ Remembers keys that recently failed to authenticate, per kind """
+
+    KINDS = ('passwordless', 'one_time_authentication')
+
+    def has_failed(self, key, kind):
+        return self.get((kind, key)) is not None
+
+    def add(self, key, kind):
+        self.set((kind, key), True)
+
+    def forget(self, key):
+        for kind in self.KINDS:
+            self.delete((kind, key))
+
+
+failed_keys = FailedKeyCache(maxsize=settings.ACCOUNT_FAILED_KEY_CACHE_SIZE,
+                             ttl=settings.ACCOUNT_FAILED_KEY_CACHE_TIMEOUT)
+
+
+def get_shared_cache(alias, setting_name):
+    """ The Django cache named alias, which every process has to see. LocMemCache is per process and is refused. """
+    if not alias:
+        raise SlothAuthInvalidSetting('%s must name a Django cache shared by all processes' % setting_name)
+    cache = caches[alias]
+    if isinstance(cache, LocMemCache):
+        raise SlothAuthInvalidSetting('%s names a LocMemCache, which is not shared between processes' % setting_name)
+    return cache
+
+
+def instance_to_row(instance):
+    """ Picklable snapshot of a model instance's field values, for caching """
+    return instance._state.db, [getattr(instance, field.attname) for field in instance._meta.concrete_fields]
+
+
+def instance_from_row(model, row):
+    """ Builds a new instance of model from a snapshot made by instance_to_row """
+    db, values = row
+    return model.from_db(db, [field.attname for field in model._meta.concrete_fields], values)
+
+
 class RandomField(models.CharField):
+    """
+    CharField that fills itself with a random key on pre_save when empty.
+
+    When the field is unique, keys are drawn from a CSPRNG and no pre-check
+    queries are made: the unique index catches the (astronomically unlikely)
+    collision and the model is expected to retry the save with fresh keys,
+    see ``SlothAuthBaseUser.save``. Non-unique fields keep the old behavior
+    of checking the table for each candidate.
+    """
     MAX_LOOPS = 10
 
     def __init__(self, seed=string.ascii_lowercase + string.digits, *args, **kwargs):
@@ -57,14 +174,24 @@ class RandomField(models.CharField):
 
     def contribute_to_class(self, class_, key):
         super(RandomField, self).contribute_to_class(class_, key)
-        models.signals.pre_save.connect(self.generate_unique, sender=class_)
-        models.signals.post_migrate.connect(self.generate_unique, sender=class_)
+        # One handler per model fills every RandomField in a single pass
+        models.signals.pre_save.connect(generate_random_fields, sender=class_,
+                                        dispatch_uid='slothauth_random_fields_%s' % id(class_))
+
+    def generate_value(self):
+        return ''.join(system_random.choice(self.seed) for x in range(self.max_length))
 
     def generate_unique(self, sender, instance, *args, **kwargs):
         if not getattr(instance, self.attname):
+            if self.unique:
+                value = self.generate_value()
+                failed_keys.forget(value)
+                setattr(instance, self.attname, value)
+                return
+
             value = None
             for i in range(0, RandomField.MAX_LOOPS):
-                value = ''.join(random.choice(self.seed) for x in range(self.max_length))
+                value = self.generate_value()
                 if sender.objects.filter(**{self.name: value}).count() > 0:
                     value = None
                 else:
@@ -77,8 +204,41 @@ class RandomField(models.CharField):
             elif i >= RandomField.MAX_LOOPS * 2/3:
                 logging.warning("Looped 2/3 the max allowable loops for unique field on %s.%s consider upping the length of the keys" % (sender._meta.module_name, self.name))
 
+            failed_keys.forget(value)
             setattr(instance, self.attname, value)
 
+
+system_random = random.SystemRandom()
+
+
+def get_random_fields(model, update_fields=None):
+    """ RandomFields of model, only those in update_fields if it is given """
+    return [field for field in model._meta.concrete_fields if isinstance(field, RandomField) and
+            (update_fields is None or field.name in update_fields or field.attname in update_fields)]
+
+
+def generate_random_fields(sender, instance, update_fields=None, *args, **kwargs):
+    # Fields left out of update_fields aren't written, so there is nothing to generate for them
+    for field in get_random_fields(sender, update_fields):
+        field.generate_unique(sender, instance)
+
+
+def find_random_field_collisions(instance, fields):
+    """
+    Returns the fields whose current value on instance is already taken by another row. Only meant to be called
+    after an IntegrityError, to tell a key collision apart from any other constraint violation.
+    """
+    query = models.Q()
+    for field in fields:
+        query |= models.Q(**{field.name: getattr(instance, field.attname)})
+    others = type(instance)._default_manager.filter(query)
+    if instance.pk is not None:
+        others = others.exclude(pk=instance.pk)
+    taken = others.values_list(*[field.attname for field in fields])
+    return [field for i, field in enumerate(fields)
+            if any(row[i] == getattr(instance, field.attname) for row in taken)]
+
+
 #
 # From https://github.com/gbourdin/django-ci-emailfield/
 #
@@ -124,3 +284,29 @@ class CiEmailField(EmailField):
                 value = value.lower()
         return super(CiEmailField, self).get_db_prep_value(
             value, connection, prepared)
+
+
+@CiEmailField.register_lookup
+class CiEmailIExact(Exact):
+    """
+    iexact for CiEmailField. Values are stored lowercased, or as CITEXT on postgresql, so lowercasing the lookup
+    value is enough and the query is a plain equality that can use the email index, instead of UPPER() or LIKE.
+    """
+    lookup_name = 'iexact'
+
+    def get_prep_lookup(self):
+        if isinstance(self.rhs, basestring):
+            self.rhs = self.rhs.lower()
+        return super(CiEmailIExact, self).get_prep_lookup()
+
+    def process_lhs(self, compiler, connection, lhs=None):
+        # BuiltinLookup casts the column for lookup_name, which would be UPPER(email::text) on postgresql
+        lhs_sql, params = super(BuiltinLookup, self).process_lhs(compiler, connection, lhs)
+        field_internal_type = self.lhs.output_field.get_internal_type()
+        db_type = self.lhs.output_field.db_type(connection=connection)
+        lhs_sql = connection.ops.field_cast_sql(db_type, field_internal_type) % lhs_sql
+        lhs_sql = connection.ops.lookup_cast('exact', field_internal_type) % lhs_sql
+        return lhs_sql, list(params)
+
+    def get_rhs_op(self, connection, rhs):
+        return connection.operators['exact'] % rhs
@@ -5,14 +5,19 @@ from django.contrib.auth import authenticate
 from django.contrib.auth import login as django_login
 from django.contrib.auth import logout as django_logout
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.shortcuts import render
 
 from rest_framework import permissions, status, viewsets
 from rest_framework.authentication import BasicAuthentication
+from rest_framework.authtoken.models import Token
 from rest_framework.decorators import list_route
 from rest_framework.response import Response
 
-from .serializers import AccountSerializer, BasicAccountSerializer
+from .bloom import email_filter
+from .middleware import get_passwordless_backend
+from .models import AuthKey
+from .serializers import AccountSerializer, BasicAccountSerializer, FastAccountSerializer
 
 from . import settings
 
@@ -38,7 +43,7 @@ class BasicUserViewSet(viewsets.GenericViewSet):
 
 
 class AuthViewSet(viewsets.GenericViewSet):
-    queryset = Account.objects.all()
+    queryset = Account.objects.select_related('auth_token')
     serializer_class = AccountSerializer
     authentication_classes = (QuietBasicAuthentication, )
     permission_classes = ()
@@ -49,9 +54,10 @@ class AuthViewSet(viewsets.GenericViewSet):
         user = authenticate(email=request.data.get('email'), username=request.data.get('username'), password=request.data.get('password'), passwordless_key=request.data.get('passwordless_key'))
         if user:
             django_login(request, user)
-            return Response(AccountSerializer(request.user).data)
+            return Response(FastAccountSerializer(request.user).data)
         elif not request.data.get('password'):
-            account = Account.objects.filter(email__iexact=request.data.get('email', '').strip()).last()
+            email = request.data.get('email', '').strip()
+            account = Account.objects.filter(email__iexact=email).last() if email_filter.might_exist(email) else None
             if account:
                 if not account.is_passwordless:
                     # Ask them for a password
@@ -78,14 +84,14 @@ class AuthViewSet(viewsets.GenericViewSet):
 
         form = AccountForm(data=request.data)
         if form.is_valid():
-            form.save()
-
-            # Force the login
-            user = authenticate(passwordless_key=form.instance.passwordless_key, force=True)
-            django_login(request, user)
-
-            user.save()
-            return Response(AccountSerializer(request.user).data)
+            # The account and its token are created, and the new account logged in, in one transaction. The login
+            # uses the instance just saved rather than looking it up again.
+            with transaction.atomic():
+                user = form.save()
+                if user:
+                    django_login(request, user, backend=get_passwordless_backend()[1])
+            if user:
+                return Response(FastAccountSerializer(request.user).data)
         return Response({'error': form.errors}, status=status.HTTP_412_PRECONDITION_FAILED)
 
     @list_route(methods=['post', 'delete'])
@@ -96,7 +102,8 @@ class AuthViewSet(viewsets.GenericViewSet):
 
 
 class AccountViewSet(viewsets.GenericViewSet):
-    queryset = Account.objects.all()
+    # AccountSerializer reads auth_token, join it rather than query it per account
+    queryset = Account.objects.select_related('auth_token')
     serializer_class = AccountSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly, )
 
@@ -105,11 +112,16 @@ class AccountViewSet(viewsets.GenericViewSet):
 
         if request.method == 'PATCH':
             form = AccountForm(instance=request.user, data=request.data)
-            if form.is_valid():
-                form.save()
-                return Response(AccountSerializer(request.user).data)
+            if form.is_valid() and form.save():
+                return Response(FastAccountSerializer(request.user).data)
             return Response({'error': form.errors}, status=status.HTTP_412_PRECONDITION_FAILED)
-        return Response(AccountSerializer(request.user).data)
+        return Response(FastAccountSerializer(request.user).data)
+
+    @list_route(methods=['get', 'post'], permission_classes=(permissions.IsAuthenticated, ))
+    def auth_token(self, request, *args, **kwargs):
+
+        token, created = Token.objects.get_or_create(user=request.user)
+        return Response({'auth_token': token.key})
 
     ###
     # change_email
@@ -130,8 +142,7 @@ class AccountViewSet(viewsets.GenericViewSet):
         if not re.match(r"[^@]+@[^@]+\.[^@]+", request.data['email']):
             return Response({'error': 'EMAIL INVALID'}, status=status.HTTP_400_BAD_REQUEST)
 
-        request.user.email = request.data['email'].strip()
-        request.user.save()
+        request.user.update(email=request.data['email'].strip())
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -155,26 +166,30 @@ class AccountViewSet(viewsets.GenericViewSet):
             return Response({'error': 'Incorrect password'}, status=status.HTTP_400_BAD_REQUEST)
 
         # Or test password_reset_key
-        if 'password_reset_key' in request.data and not request.data.get('password_reset_key') == request.user.password_reset_key:
+        if 'password_reset_key' in request.data and settings.ACCOUNT_AUTH_KEYS:
+            if AuthKey.objects.consume(request.data.get('password_reset_key'), AuthKey.PASSWORD_RESET,
+                                       user=request.user) is None:
+                return Response({'error': 'Incorrect password reset key'}, status=status.HTTP_400_BAD_REQUEST)
+        elif 'password_reset_key' in request.data and not request.data.get('password_reset_key') == request.user.password_reset_key:
             return Response({'error': 'Incorrect password reset key'}, status=status.HTTP_400_BAD_REQUEST)
 
+        update_fields = ['password']
+
         # If the password_reset_key was attempted to be used, then reset it
-        if 'password_reset_key' in request.data and not request.data.get('password_reset_key') == '':
-            request.user.password_reset_key = Account._meta.get_field('password_reset_key').generate_unique(instance=request.user, sender=Account)
+        if 'password_reset_key' in request.data and not request.data.get('password_reset_key') == '' and not settings.ACCOUNT_AUTH_KEYS:
+            # Emptied, a new key is generated when the account is saved
+            request.user.password_reset_key = ''
+            update_fields.append('password_reset_key')
 
         request.user.set_password(request.data['password'])
-        request.user.save()
+        request.user.save(update_fields=update_fields)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @list_route(methods=['post', 'patch'])
     def change_settings(self, request, *args, **kwargs):
 
-        if 'first_name' in request.data:
-            request.user.first_name = request.data['first_name']
-        if 'last_name' in request.data:
-            request.user.last_name = request.data['last_name']
-
-        request.user.save()
+        request.user.update(**dict((name, request.data[name]) for name in ('first_name', 'last_name')
+                                   if name in request.data))
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_mocks', '0004_auto_20170816_1358'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='auth_key_version',
+            field=models.PositiveIntegerField(default=0, help_text='Signed keys issued for an older version are rejected.', verbose_name='auth key version'),
+        ),
+    ]
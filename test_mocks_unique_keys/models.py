@@ -0,0 +1,9 @@
+from slothauth.models import SlothAuthBaseUser
+from slothauth.utils import RandomField
+
+
+class Account(SlothAuthBaseUser):
+    """ The test account with unique keys, installed instead of test_mocks when ACCOUNT_KEYS_UNIQUE is on """
+    passwordless_key = RandomField(max_length=32, blank=True, unique=True)
+    one_time_authentication_key = RandomField(max_length=32, blank=True, unique=True)
+    password_reset_key = RandomField(max_length=32, blank=True, unique=True)